@@ -0,0 +1,425 @@
+"""Archive converter.
+
+Converts ydata.bin of archives written by `save_file.write_archive_xy` into
+formats of the analysis stack:
+
+    .npy        frames as (N, samples) array
+    .npz        'y' frames, 'x' times, 'frame_info' (journal.FRAME_INFO) and
+                'metadata' (json string)
+    .parquet    row per frame: acquisition, timestamp and y (fixed size list),
+                metadata in schema metadata (requires pyarrow)
+    .h5/.hdf5   datasets 'y', 'x', 'frame_info', metadata in 'metadata'
+                attribute (requires h5py)
+
+ydata.bin is streamed from the archive in chunks of whole frames, it's never
+decompressed into memory or to a temporary file. Deflate stream can only be
+inflated sequentially, so chunks are read on the calling thread while
+selection, scaling and casting of previous chunks run in a thread pool
+(numpy releases the GIL), chunks are written in order.
+"""
+import json
+import os
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from time import perf_counter
+
+from numpy import (frombuffer, float64, arange, zeros, nan, loadtxt,
+                   searchsorted, ascontiguousarray, save, array, dtype as np_dtype)
+from numpy.lib import format as npy_format
+from numpy.typing import NDArray
+
+from journal import FRAME_INFO
+from streaming import quantize
+
+FORMATS = {
+    '.npy'      : 'npy',
+    '.npz'      : 'npz',
+    '.parquet'  : 'parquet',
+    '.h5'       : 'hdf5',
+    '.hdf5'     : 'hdf5',
+}
+DTYPES = ('float64', 'float32', 'int16')
+
+class ArchiveReader:
+    def __init__(self, archive_path : str) -> None:
+        """Reader of archive or extracted archive directory. Only metadata,
+        xdata.csv and frames.bin are read on open, frames are streamed by `chunks`.
+
+        Args:
+            archive_path (str): path to zip archive or extracted archive directory
+        """
+        self.archive_path   = archive_path
+        self.archive_file   = None
+
+        if os.path.isdir(archive_path):
+            def read(name):
+                with open(os.path.join(archive_path, name), 'rb') as file:
+                    return file.read()
+            self._ydata_name = os.path.join(archive_path, 'ydata.bin')
+            ydata_size  = os.path.getsize(self._ydata_name)
+            has_info    = os.path.exists(os.path.join(archive_path, 'frames.bin'))
+        else:
+            self.archive_file = zipfile.ZipFile(archive_path, 'r')
+            names       = self.archive_file.namelist()
+            directory   = os.path.dirname(next(n for n in names if n.endswith('metadata.txt')))
+            read        = lambda name: self.archive_file.read(os.path.join(directory, name))
+            self._ydata_name = os.path.join(directory, 'ydata.bin')
+            ydata_size  = self.archive_file.getinfo(self._ydata_name).file_size
+            has_info    = os.path.join(directory, 'frames.bin') in names
+
+        self.metadata       = json.loads(read('metadata.txt'))
+        self.record_length  = self.metadata['scope']['record_length']
+        self.frame_bytes    = self.record_length * float64().itemsize
+        self.n_frames       = ydata_size // self.frame_bytes
+        self.x              = loadtxt(BytesIO(read('xdata.csv')), dtype=float64, ndmin=1)
+        self.frame_info     = frombuffer(read('frames.bin'), dtype=FRAME_INFO) if has_info else None
+
+    @property
+    def preamble(self) -> dict:
+        """Scope waveform scaling, None for archives saved without it.
+        """
+        return self.metadata['scope'].get('preamble')
+
+    def frameInfo(self, start : int, stop : int) -> NDArray:
+        """frames.bin rows of frames, acquisition numbers and NaN times for
+        archives saved without it.
+        """
+        if self.frame_info is not None and len(self.frame_info) >= stop:
+            return self.frame_info[start:stop]
+
+        # times are unknown
+        info = zeros(stop - start, dtype=FRAME_INFO)
+        info['acquisition'] = arange(start, stop)
+        for name in ('timestamp', 'trigger_time', 'transfer_time'):
+            info[name] = nan
+        return info
+
+    def chunks(self, start : int = 0, stop : int = None, chunk_frames : int = 256):
+        """Yields (first frame, frames of shape (n, record_length)), chunks are
+        read straight from the deflate stream.
+        """
+        stop = self.n_frames if stop is None else min(stop, self.n_frames)
+        if self.archive_file is None:
+            source = open(self._ydata_name, 'rb')
+        else:
+            source = self.archive_file.open(self._ydata_name)
+
+        with source:
+            # zip members seek forward by inflating and discarding
+            source.seek(start * self.frame_bytes)
+            for first in range(start, stop, chunk_frames):
+                n = min(chunk_frames, stop - first)
+                buffer = bytearray(n * self.frame_bytes)
+                view, received = memoryview(buffer), 0
+                while received < len(buffer):
+                    read = source.readinto(view[received:])
+                    if not read:
+                        raise EOFError(f'{self.archive_path}: ydata.bin ends at frame {first}.')
+                    received += read
+                yield first, frombuffer(buffer, dtype=float64).reshape((n, self.record_length))
+
+    def close(self) -> None:
+        if self.archive_file is not None:
+            self.archive_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+def parse_range(text : str, cast : type = float) -> tuple:
+    """'start:stop' (either side may be empty) as (start, stop), None for missing ends.
+    """
+    start, _, stop = text.partition(':')
+    return (cast(start) if start else None, cast(stop) if stop else None)
+
+def select_frames(reader : ArchiveReader, frames : tuple = None, session_time : tuple = None) -> tuple:
+    """Frame range of selection.
+
+    Args:
+        reader (ArchiveReader): source archive
+        frames (tuple, optional): (start, stop) frame indices. Defaults to None (all frames).
+        session_time (tuple, optional): (t0, t1) in seconds from the first frame, uses
+            frames.bin timestamps. Defaults to None (no time window).
+
+    Returns:
+        tuple: (start, stop) frame indices
+    """
+    start, stop = frames or (None, None)
+    start = 0 if start is None else max(0, start)
+    stop  = reader.n_frames if stop is None else min(stop, reader.n_frames)
+
+    if session_time != None:
+        info = reader.frame_info
+        if info is None or len(info) < reader.n_frames:
+            raise ValueError(f'{reader.archive_path} has no frame times (frames.bin).')
+        times = info['timestamp'][:reader.n_frames] - info['timestamp'][0]
+        t0, t1 = session_time
+        if t0 != None:
+            start = max(start, int(searchsorted(times, t0, side='left')))
+        if t1 != None:
+            stop  = min(stop, int(searchsorted(times, t1, side='left')))
+
+    return start, max(start, stop)
+
+def select_samples(reader : ArchiveReader, window : tuple = None) -> slice:
+    """Samples of each frame within (t0, t1) of scope time axis (xdata.csv).
+    """
+    if window is None:
+        return slice(0, reader.record_length)
+    t0, t1 = window
+    start = 0 if t0 is None else int(searchsorted(reader.x, t0, side='left'))
+    stop  = reader.record_length if t1 is None else int(searchsorted(reader.x, t1, side='left'))
+    return slice(start, max(start, stop))
+
+def transform(y : NDArray, samples : slice, scale : float, out_dtype : str, preamble : dict) -> NDArray:
+    """Selected samples of frames scaled and cast to out_dtype, int16 is
+    re-quantized with the scope preamble (lossless for unscaled frames).
+    """
+    y = y[:, samples]
+    if scale != 1.:
+        y = y * scale
+    if out_dtype == 'int16':
+        return quantize(y, preamble)
+    return ascontiguousarray(y, dtype=out_dtype)
+
+class NpyWriter:
+    def __init__(self, path : str, shape : tuple, out_dtype : str, reader : ArchiveReader,
+                 info : NDArray, x : NDArray, metadata : dict) -> None:
+        self.array = npy_format.open_memmap(path, mode='w+', dtype=out_dtype, shape=shape)
+        self.row   = 0
+
+    def write(self, y : NDArray) -> None:
+        self.array[self.row:self.row + len(y)] = y
+        self.row += len(y)
+
+    def close(self) -> None:
+        self.array.flush()
+        del self.array
+
+class NpzWriter:
+    def __init__(self, path : str, shape : tuple, out_dtype : str, reader : ArchiveReader,
+                 info : NDArray, x : NDArray, metadata : dict) -> None:
+        # stored, frames are usually incompressible noise and numpy can't mmap deflated members
+        self.archive_file = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+        for name, value in (('x', x), ('frame_info', info), ('metadata', array(json.dumps(metadata)))):
+            buffer = BytesIO()
+            save(buffer, value, allow_pickle=False)
+            self.archive_file.writestr(f'{name}.npy', buffer.getvalue())
+
+        self.member = self.archive_file.open('y.npy', 'w', force_zip64=True)
+        npy_format.write_array_header_2_0(self.member, {
+            'descr'         : npy_format.dtype_to_descr(np_dtype(out_dtype)),
+            'fortran_order' : False,
+            'shape'         : shape,
+        })
+
+    def write(self, y : NDArray) -> None:
+        self.member.write(memoryview(y).cast('B'))
+
+    def close(self) -> None:
+        self.member.close()
+        self.archive_file.close()
+
+class ParquetWriter:
+    def __init__(self, path : str, shape : tuple, out_dtype : str, reader : ArchiveReader,
+                 info : NDArray, x : NDArray, metadata : dict) -> None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError('Parquet export requires pyarrow (pip install pyarrow).')
+
+        self.pyarrow    = pyarrow
+        self.info       = info
+        self.row        = 0
+        self.samples    = shape[1]
+        self.schema     = pyarrow.schema([
+            ('acquisition', pyarrow.int64()),
+            ('timestamp',   pyarrow.float64()),
+            ('y',           pyarrow.list_(pyarrow.from_numpy_dtype(np_dtype(out_dtype)), shape[1])),
+        ], metadata={'bubbles_metadata': json.dumps(metadata), 'x': json.dumps(x.tolist())})
+        self.writer     = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, y : NDArray) -> None:
+        info = self.info[self.row:self.row + len(y)]
+        # row group per chunk
+        self.writer.write_table(self.pyarrow.Table.from_arrays([
+            self.pyarrow.array(info['acquisition']),
+            self.pyarrow.array(info['timestamp']),
+            self.pyarrow.FixedSizeListArray.from_arrays(self.pyarrow.array(y.reshape(-1)), self.samples),
+        ], schema=self.schema))
+        self.row += len(y)
+
+    def close(self) -> None:
+        self.writer.close()
+
+class Hdf5Writer:
+    def __init__(self, path : str, shape : tuple, out_dtype : str, reader : ArchiveReader,
+                 info : NDArray, x : NDArray, metadata : dict, chunk_frames : int = 256) -> None:
+        try:
+            import h5py
+        except ImportError:
+            raise RuntimeError('HDF5 export requires h5py (pip install h5py).')
+
+        self.file = h5py.File(path, 'w')
+        self.file.attrs['metadata'] = json.dumps(metadata)
+        self.file['x']          = x
+        self.file['frame_info'] = info
+        self.dataset = self.file.create_dataset(
+            'y', shape=shape, dtype=out_dtype,
+            chunks=(max(1, min(chunk_frames, shape[0])), max(1, shape[1])) if shape[0] and shape[1] else None,
+        )
+        self.row = 0
+
+    def write(self, y : NDArray) -> None:
+        self.dataset[self.row:self.row + len(y)] = y
+        self.row += len(y)
+
+    def close(self) -> None:
+        self.file.close()
+
+WRITERS = {
+    'npy'       : NpyWriter,
+    'npz'       : NpzWriter,
+    'parquet'   : ParquetWriter,
+    'hdf5'      : Hdf5Writer,
+}
+
+def convert(archive_path : str, dest : str, fmt : str = None,
+            frames : tuple = None, session_time : tuple = None, window : tuple = None,
+            out_dtype : str = 'float64', scale : float = 1.,
+            chunk_frames : int = 256, workers : int = None, progress = None) -> dict:
+    """Convert archive frames into npy/npz/parquet/hdf5 file.
+
+    Args:
+        archive_path (str): archive (.zip) or extracted archive directory
+        dest (str): destination file
+        fmt (str, optional): 'npy', 'npz', 'parquet' or 'hdf5'. Defaults to None (from dest extension).
+        frames (tuple, optional): (start, stop) frame indices. Defaults to None (all frames).
+        session_time (tuple, optional): (t0, t1) seconds from the first frame. Defaults to None.
+        window (tuple, optional): (t0, t1) of scope time axis, selects samples of each frame. Defaults to None.
+        out_dtype (str, optional): 'float64', 'float32' or 'int16' (raw scope counts,
+            needs preamble in metadata). Defaults to 'float64'.
+        scale (float, optional): factor applied to voltage (e.g. 1e3 for mV). Defaults to 1.
+        chunk_frames (int, optional): frames per chunk. Defaults to 256.
+        workers (int, optional): transform threads. Defaults to None (all cores).
+        progress (Callable, optional): called with (frames done, frames total). Defaults to None.
+
+    Returns:
+        dict: conversion statistics {'frames', 'samples', 'bytes_read', 'bytes_written',
+              'read_time', 'transform_time', 'write_time', 'wall_time'}
+    """
+    if fmt is None:
+        fmt = FORMATS.get(os.path.splitext(dest)[1].lower())
+        if fmt is None:
+            raise ValueError(f'Unknown format of {dest}, use one of: {", ".join(FORMATS)}.')
+    if out_dtype not in DTYPES:
+        raise ValueError(f'Unsupported dtype {out_dtype}, use one of: {", ".join(DTYPES)}.')
+
+    workers = workers or os.cpu_count() or 1
+    stats = dict.fromkeys(('read_time', 'transform_time', 'write_time'), 0.)
+
+    def timed_transform(y):
+        t = perf_counter()
+        result = transform(y, samples, scale, out_dtype, reader.preamble)
+        return result, perf_counter() - t
+
+    t_start = perf_counter()
+    with ArchiveReader(archive_path) as reader:
+        if out_dtype == 'int16' and reader.preamble is None:
+            raise ValueError(f'{archive_path} has no scope preamble, int16 export is not possible.')
+        if out_dtype == 'int16' and scale != 1.:
+            raise ValueError('int16 export stores raw scope counts, it can\'t be scaled.')
+
+        start, stop = select_frames(reader, frames, session_time)
+        samples     = select_samples(reader, window)
+        shape       = (stop - start, samples.stop - samples.start)
+
+        metadata = dict(reader.metadata)
+        metadata['conversion'] = {
+            'source'    : os.path.basename(archive_path),
+            'frames'    : [start, stop],
+            'samples'   : [samples.start, samples.stop],
+            'dtype'     : out_dtype,
+            'scale'     : scale,
+        }
+        metadata.pop('description', None)
+
+        kwargs = {'chunk_frames': chunk_frames} if fmt == 'hdf5' else {}
+        writer = WRITERS[fmt](dest, shape, out_dtype, reader,
+                              reader.frameInfo(start, stop), reader.x[samples], metadata, **kwargs)
+        try:
+            with ThreadPoolExecutor(workers) as executor:
+                pending, done = deque(), 0
+                chunks = reader.chunks(start, stop, chunk_frames)
+                while True:
+                    t = perf_counter()
+                    chunk = next(chunks, None)
+                    stats['read_time'] += perf_counter() - t
+                    if chunk != None:
+                        pending.append(executor.submit(timed_transform, chunk[1]))
+
+                    # bounded read-ahead, chunks are written in order
+                    while pending and (len(pending) > workers or chunk is None):
+                        y, transform_time = pending.popleft().result()
+                        t = perf_counter()
+                        writer.write(y)
+                        stats['write_time'] += perf_counter() - t
+                        stats['transform_time'] += transform_time
+
+                        done += len(y)
+                        if progress != None:
+                            progress(done, shape[0])
+
+                    if chunk is None:
+                        break
+        finally:
+            writer.close()
+
+    stats.update({
+        'frames'        : shape[0],
+        'samples'       : shape[1],
+        'bytes_read'    : shape[0] * reader.frame_bytes,
+        'bytes_written' : os.path.getsize(dest),
+        'wall_time'     : perf_counter() - t_start,
+    })
+    return stats
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Convert archive frames to npy, npz, parquet or hdf5.')
+    parser.add_argument('archive', help='archive (.zip) or extracted archive directory')
+    parser.add_argument('dest', help='destination file (.npy, .npz, .parquet, .h5)')
+    parser.add_argument('--format', choices=sorted(set(FORMATS.values())), default=None,
+                        help='output format, taken from dest extension if omitted')
+    parser.add_argument('--frames', type=lambda text: parse_range(text, int), default=None,
+                        metavar='START:STOP', help='frame index range')
+    parser.add_argument('--session-time', type=parse_range, default=None,
+                        metavar='T0:T1', help='frames acquired within seconds from the first frame')
+    parser.add_argument('--window', type=parse_range, default=None,
+                        metavar='T0:T1', help='samples within scope time window (s)')
+    parser.add_argument('--dtype', choices=DTYPES, default='float64',
+                        help='output dtype, int16 stores raw scope counts')
+    parser.add_argument('--scale', type=float, default=1., help='voltage factor, e.g. 1e3 for mV')
+    parser.add_argument('--chunk-frames', type=int, default=256, help='frames per chunk')
+    parser.add_argument('--workers', type=int, default=None, help='transform threads')
+    parser.add_argument('--benchmark', action='store_true', help='print throughput of conversion stages')
+    args = parser.parse_args()
+
+    stats = convert(args.archive, args.dest, args.format,
+                    frames=args.frames, session_time=args.session_time, window=args.window,
+                    out_dtype=args.dtype, scale=args.scale,
+                    chunk_frames=args.chunk_frames, workers=args.workers)
+
+    print(f"Converted {stats['frames']} frames x {stats['samples']} samples into {args.dest}")
+    if args.benchmark:
+        mb = stats['bytes_read'] / 1e6
+        for stage in ('read_time', 'transform_time', 'write_time', 'wall_time'):
+            seconds = stats[stage]
+            print(f"{stage:15s} {seconds:8.3f} s {mb / seconds if seconds > 0 else float('inf'):10.1f} MB/s")
+        print(f"read {mb:.1f} MB, wrote {stats['bytes_written'] / 1e6:.1f} MB")
@@ -1,8 +1,11 @@
-from numpy import array, mean, searchsorted, any, iinfo, int64
+from numpy import (array, mean, searchsorted, any, iinfo, int64, asarray,
+                   median, stack, take_along_axis, maximum, memmap, float64,
+                   concatenate, empty, absolute, nan)
 from numpy.typing import ArrayLike
+from abc import ABC, abstractmethod
 
-from scipy.fft import fftfreq, fft
-from scipy.signal import find_peaks  # For advanced smoothing
+# scipy is imported inside functions, it's slow to import and not needed
+# before the first connection
 
 def clip(x:float, vmin:float, vmax:float) -> float:
     return max(vmin, min(x, vmax))
@@ -22,6 +25,8 @@ def find_argpeaks_around_f(xf:ArrayLike, yf:ArrayLike, f:float, threshold: float
     Returns:
         int: index of peak
     """    
+    from scipy.signal import find_peaks
+
     argrange = (
         searchsorted(xf, f * 0.95),  # 95% of f
         searchsorted(xf, f * 1.05)   # 105% of f
@@ -38,6 +43,35 @@ def find_argpeaks_around_f(xf:ArrayLike, yf:ArrayLike, f:float, threshold: float
     else:
         return argpeaks[0]
 
+def band_peaks(xf:ArrayLike, yf:ArrayLike, freqs:ArrayLike, rel_width:float=0.05) -> tuple:
+    """Vectorized band maximum in +- rel_width range around each of freqs.
+    Works on a single spectrum or a block of spectra (frequency on last axis).
+
+    Args:
+        xf (ArrayLike): frequency values - sorted
+        yf (ArrayLike): signal spectrum/spectra, shape (..., len(xf))
+        freqs (ArrayLike): centre frequencies of bands
+        rel_width (float, optional): relative half width of band. Defaults to 0.05.
+
+    Returns:
+        tuple: (peak magnitudes, peak indexes, band floors) each of shape (..., len(freqs)).
+            Band floor is median magnitude of the band.
+    """
+    yf = asarray(yf)
+    peaks, argpeaks, floors = [], [], []
+    for f in freqs:
+        # bands above the last frequency shrink to the last bin
+        lo = min(searchsorted(xf, f * (1 - rel_width)), len(xf) - 1)
+        hi = max(searchsorted(xf, f * (1 + rel_width)), lo + 1)
+        band = yf[..., lo:hi]
+
+        argpeak = band.argmax(axis=-1)
+        peaks.append(take_along_axis(band, argpeak[..., None], axis=-1)[..., 0])
+        argpeaks.append(argpeak + lo)
+        floors.append(median(band, axis=-1))
+
+    return stack(peaks, axis=-1), stack(argpeaks, axis=-1), stack(floors, axis=-1)
+
 def subharmonic_detected(xf:ArrayLike, yf:ArrayLike, f0:float, threshold: float) -> bool:
     """If any subharmonic detected return true
     if none detected return false.
@@ -65,6 +99,126 @@ def subharmonic_detected(xf:ArrayLike, yf:ArrayLike, f0:float, threshold: float)
 
     return bool(any(distance < 8))
 
+def subharmonic_prominence(xf:ArrayLike, yf:ArrayLike, f0:float) -> tuple:
+    """Vectorized subharmonic peak prominence at 3/2 f0 and 5/2 f0. The tallest
+    sample of each +- 5% band rises above both of its neighbours by prominence.
+    Peaks further than 8 bins from expected subharmonic frequency have zero prominence,
+    as in `subharmonic_detected`.
+
+    Args:
+        xf (ArrayLike): frequency values - sorted
+        yf (ArrayLike): signal spectrum/spectra, shape (..., len(xf))
+        f0 (float): generator frequency
+
+    Returns:
+        tuple: (prominences, peak magnitudes) each of shape (..., 2)
+    """
+    yf = asarray(yf)
+
+    freqs = (3/2*f0, 5/2*f0)
+    peaks, argpeaks, _ = band_peaks(xf, yf, freqs)
+
+    left  = take_along_axis(yf, (argpeaks - 1).clip(0), axis=-1)
+    right = take_along_axis(yf, (argpeaks + 1).clip(max=yf.shape[-1] - 1), axis=-1)
+    prominence = peaks - maximum(left, right)
+
+    expected = searchsorted(xf, freqs)
+    prominence[abs(argpeaks - expected) >= 8] = 0
+
+    return prominence, peaks
+
+def subharmonic_margin(xf:ArrayLike, yf:ArrayLike, f0:float, threshold:float) -> float:
+    """Distance of the highest subharmonic peak prominence from threshold.
+    Non-negative when subharmonics are detected.
+
+    Args:
+        xf (ArrayLike): frequency values - sorted
+        yf (ArrayLike): signal spectrum
+        f0 (float): generator frequency
+        threshold (float): peak threshold
+
+    Returns:
+        float: margin
+    """
+    prominence, _ = subharmonic_prominence(xf, yf, f0)
+    return float(prominence.max() - threshold)
+
+def _subharmonic_chunk(y:ArrayLike, sample_rate:float, f0:float, threshold:float) -> tuple:
+    """Per-frame equivalent of `subharmonic_detected` for block of frames (N, samples).
+
+    Returns:
+        tuple: (flags (N,), peak magnitudes (N, 2))
+    """
+    from scipy.fft import rfft, rfftfreq
+
+    y  = asarray(y, dtype=float64)
+    xf = rfftfreq(y.shape[1], 1/sample_rate)
+    # chunks are already processed in parallel, keep fft single threaded
+    yf = abs(rfft(y, axis=1, workers=1))
+
+    prominence, peaks = subharmonic_prominence(xf, yf, f0)
+
+    return (prominence >= threshold).any(axis=1), peaks
+
+def _subharmonic_batch_worker(source, record_length:int, start:int, stop:int,
+                              sample_rate:float, f0:float, threshold:float) -> tuple:
+    """Processes frames [start, stop) of array or binary file (opened as memmap
+    in the worker, so only file path is sent to worker processes).
+    """
+    if isinstance(source, str):
+        source = memmap(source, dtype=float64, mode='r').reshape((-1, record_length))
+    return _subharmonic_chunk(source[start:stop], sample_rate, f0, threshold)
+
+def subharmonic_detected_batch(y, sample_rate:float, f0:float, threshold:float=100,
+                               record_length:int=None, chunk_size:int=1024,
+                               max_workers:int=None, use_processes:bool=False) -> tuple:
+    """Batched per-frame subharmonic detection for offline reprocessing.
+    Frames are split into chunks processed in a thread pool (scipy.fft releases
+    the GIL) or a process pool.
+
+    Args:
+        y (ArrayLike | str): block of frames (N, samples) or path to ydata.bin (float64)
+        sample_rate (float): sample rate of frames
+        f0 (float): generator frequency
+        threshold (float, optional): peak threshold, same as in AmplitudeRegulator. Defaults to 100.
+        record_length (int, optional): samples per frame, required if y is a path. Defaults to None.
+        chunk_size (int, optional): number of frames per chunk. Defaults to 1024.
+        max_workers (int, optional): number of workers. Defaults to None (all cores).
+        use_processes (bool, optional): use process pool instead of threads. Defaults to False.
+
+    Returns:
+        tuple: (flags (N,) bool, peak magnitudes at 3/2 f0 and 5/2 f0 (N, 2))
+    """
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+    if isinstance(y, str):
+        if record_length is None:
+            raise ValueError('record_length is required when reading frames from file.')
+        n_frames = len(memmap(y, dtype=float64, mode='r')) // record_length
+    else:
+        y = asarray(y)
+        record_length = y.shape[1]
+        n_frames = y.shape[0]
+        if use_processes:
+            raise ValueError('Process pool requires y to be a path to binary file.')
+
+    if n_frames == 0:
+        return empty(0, dtype=bool), empty((0, 2))
+
+    Executor = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with Executor(max_workers=max_workers) as executor:
+        results = list(executor.map(
+            _subharmonic_batch_worker,
+            *zip(*(
+                (y, record_length, start, min(start + chunk_size, n_frames),
+                 sample_rate, f0, threshold)
+                for start in range(0, n_frames, chunk_size)
+            ))
+        ))
+
+    flags, peaks = zip(*results)
+    return concatenate(flags), concatenate(peaks)
+
 def calculate_voltage(v0 : float, xf: ArrayLike, yf_mag: ArrayLike, f0: float, threshold: float) -> float:
     """Calculates new voltage value based on the current voltage and presence of subharmonics.
     Maximum rate of change is dv = 0.02 V. Resoulting voltage is cliped to stay below 2V for savety reasons.
@@ -90,6 +244,149 @@ def calculate_voltage(v0 : float, xf: ArrayLike, yf_mag: ArrayLike, f0: float, t
     
     return clip(v0+dv, 0.020, 2.0) # min voltage 20 mV, max voltage 2 V
 
+class ControlStrategy(ABC):
+    vmin = 0.020    # min voltage 20 mV
+    vmax = 2.0      # max voltage 2 V
+
+    def __init__(self, max_slew:float=0.1, hysteresis:float=0.) -> None:
+        """Base class of amplitude control strategies. Subclasses implement `step`,
+        calling the strategy applies hysteresis, slew-rate limit and safety clip.
+
+        Args:
+            max_slew (float, optional): max voltage change per update in V. Defaults to 0.1.
+            hysteresis (float, optional): voltage is held while margin is within
+                [-hysteresis, 0), i.e. just below threshold. Defaults to 0.
+        """
+        self.max_slew   = max_slew
+        self.hysteresis = hysteresis
+
+    @abstractmethod
+    def step(self, v0:float, margin:float) -> float:
+        """Proposes new voltage.
+
+        Args:
+            v0 (float): current voltage
+            margin (float): subharmonic margin, non-negative when subharmonics are detected
+
+        Returns:
+            float: proposed voltage
+        """
+
+    def reset(self) -> None:
+        """Forget state, called when operating conditions change.
+        """
+        pass
+
+    def __call__(self, v0:float, margin:float) -> float:
+        if -self.hysteresis <= margin < 0:
+            return clip(v0, self.vmin, self.vmax)
+
+        v = self.step(v0, margin)
+        v = clip(v, v0 - self.max_slew, v0 + self.max_slew)
+        return clip(v, self.vmin, self.vmax)
+
+class FixedStepStrategy(ControlStrategy):
+    def __init__(self, dv:float=0.02, **kwargs) -> None:
+        """Moves voltage by dv, down if subharmonics are detected, up otherwise.
+        Behaviour of `calculate_voltage`.
+        """
+        super().__init__(**kwargs)
+        self.dv = dv
+
+    def step(self, v0:float, margin:float) -> float:
+        return v0 - self.dv if margin >= 0 else v0 + self.dv
+
+class BisectionStrategy(ControlStrategy):
+    def __init__(self, initial_step:float=0.02, tolerance:float=0.01,
+                 reprobe_interval:int=30, **kwargs) -> None:
+        """Brackets subharmonic threshold voltage between the highest voltage without
+        (lo) and the lowest voltage with subharmonics (hi), then bisects the bracket.
+        Until both ends are known, step is doubled every update (limited by max_slew).
+        Once bracket is narrower than tolerance voltage is held at lo. Bracket ends
+        contradicted by new measurements are dropped. Downward threshold drift shows
+        up at lo immediately, upward drift is found by probing lo + tolerance every
+        reprobe_interval held updates (one update with subharmonics if it didn't drift).
+
+        Args:
+            initial_step (float, optional): first step of bracket expansion in V. Defaults to 0.02.
+            tolerance (float, optional): bracket width at which search stops in V. Defaults to 0.01.
+            reprobe_interval (int, optional): held updates between probes above lo,
+                0 disables probing (upward drift isn't followed). Defaults to 30.
+        """
+        super().__init__(**kwargs)
+        self.initial_step       = initial_step
+        self.tolerance          = tolerance
+        self.reprobe_interval   = reprobe_interval
+        self.reset()
+
+    def reset(self) -> None:
+        self.lo     = None
+        self.hi     = None
+        self._step  = self.initial_step
+        self._held  = 0     # updates held at lo since the last probe
+
+    def step(self, v0:float, margin:float) -> float:
+        if margin >= 0:
+            self.hi = v0
+            if self.lo is not None and self.lo >= v0:
+                self.lo = None
+        else:
+            self.lo = v0
+            if self.hi is not None and self.hi <= v0:
+                self.hi = None
+
+        if self.lo is not None and self.hi is not None:
+            self._step = self.initial_step
+            if self.hi - self.lo <= self.tolerance:
+                self._held += 1
+                if self.reprobe_interval and self._held >= self.reprobe_interval:
+                    self._held = 0
+                    return self.lo + self.tolerance
+                return self.lo
+            self._held = 0
+            return (self.lo + self.hi) / 2
+
+        # expand bracket
+        self._held = 0
+        v = v0 + self._step if self.hi is None else v0 - self._step
+        self._step = min(2*self._step, self.max_slew)
+        return v
+
+class PIStrategy(ControlStrategy):
+    def __init__(self, kp:float=5e-4, ki:float=1e-3, setpoint:float=-10., **kwargs) -> None:
+        """PI controller (velocity form) keeping subharmonic margin at setpoint.
+        Margin is measured in spectrum magnitude units, so gains are in V per unit.
+        Below threshold margin saturates at -threshold (no peak), so the controller
+        settles only if peak prominence grows smoothly with voltage, otherwise it
+        keeps cycling around threshold within max_slew - use hysteresis then.
+
+        Args:
+            kp (float, optional): proportional gain. Defaults to 5e-4.
+            ki (float, optional): integral gain. Defaults to 1e-3.
+            setpoint (float, optional): target margin, slightly below threshold. Defaults to -10.
+        """
+        super().__init__(**kwargs)
+        self.kp         = kp
+        self.ki         = ki
+        self.setpoint   = setpoint
+        self.reset()
+
+    def reset(self) -> None:
+        self._error = None
+
+    def step(self, v0:float, margin:float) -> float:
+        error = self.setpoint - margin
+        previous = error if self._error is None else self._error
+        self._error = error
+
+        return v0 + self.kp*(error - previous) + self.ki*error
+
+CONTROL_STRATEGIES = {
+    'fixed'     : FixedStepStrategy,
+    'bisection' : BisectionStrategy,
+    'pi'        : PIStrategy,
+}
+
 class RollingRegister(list):
     def __init__(self, maxlen : int) -> None:
         """Rolling register based on list. Keeps last maxlen records.
@@ -109,22 +406,193 @@ class RollingRegister(list):
         if len(self) > self._maxlen:
             super().pop(0)
 
+    def extend(self, iterable) -> None:
+        super().extend(iterable)
+        if len(self) > self._maxlen:
+            del self[:len(self) - self._maxlen]
+
+class Decimator:
+    def __init__(self, max_harmonic:float=3., margin:float=1.25, max_factor:int=100) -> None:
+        """Anti-aliased polyphase decimation of frames before spectral analysis.
+        Subharmonic detection needs content up to max_harmonic * f0 only, so the
+        decimation factor is the largest one keeping new Nyquist frequency above
+        margin * max_harmonic * f0. Filters are designed once per (sample_rate, f0).
+
+        Args:
+            max_harmonic (float, optional): highest needed frequency in multiples of f0. Defaults to 3.
+            margin (float, optional): filter transition band margin. Defaults to 1.25.
+            max_factor (int, optional): max decimation factor. Defaults to 100.
+        """
+        self.max_harmonic   = max_harmonic
+        self.margin         = margin
+        self.max_factor     = max_factor
+        self._filters       = {}    # (sample_rate, f0) -> (factor, taps)
+
+    def factor(self, sample_rate:float, f0:float) -> int:
+        q = int(sample_rate / (2 * self.margin * self.max_harmonic * f0))
+        return max(1, min(q, self.max_factor))
+
+    def design(self, sample_rate:float, f0:float) -> tuple:
+        """Cached decimation factor and FIR filter taps for sample rate and f0.
+        Filter is the one resample_poly designs by default (kaiser windowed sinc).
+        """
+        key = (sample_rate, f0)
+        if key not in self._filters:
+            from scipy.signal import firwin
+
+            q = self.factor(sample_rate, f0)
+            taps = firwin(2 * 10 * q + 1, 1 / q, window=('kaiser', 5.0)) if q > 1 else None
+            self._filters[key] = (q, taps)
+
+        return self._filters[key]
+
+    def __call__(self, y:ArrayLike, sample_rate:float, f0:float) -> tuple:
+        """Decimate frame(s), samples on last axis.
+
+        Returns:
+            tuple: (decimated frame(s), decimation factor)
+        """
+        q, taps = self.design(sample_rate, f0)
+        if q == 1:
+            return asarray(y), 1
+
+        from scipy.signal import resample_poly
+        return resample_poly(y, 1, q, axis=-1, window=taps), q
+
+class SpectralEngine:
+    def __init__(self, workers:int=None) -> None:
+        """Mean magnitude spectrum of a stack of real signals. Transforms run on a
+        persistent single-thread executor (off the GUI thread), each transform uses
+        `workers` threads of scipy.fft. Input stack and magnitude buffers are
+        preallocated per (number of signals, signal length) and reused, scipy.fft
+        has no `out` parameter, so only the complex rfft output is allocated.
+
+        Args:
+            workers (int, optional): scipy.fft worker threads. Defaults to None (all cores).
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        from os import cpu_count
+
+        self.workers    = workers or cpu_count() or 1
+        self._executor  = ThreadPoolExecutor(max_workers=1)
+        self._plan      = None  # (shape, sample_rate, stack, magnitude, xf)
+
+    def _buffers(self, shape:tuple, sample_rate:float) -> tuple:
+        if self._plan is None or self._plan[:2] != (shape, sample_rate):
+            from scipy.fft import rfftfreq
+
+            n = shape[1]
+            self._plan = (
+                shape, sample_rate,
+                empty(shape),                           # input stack
+                empty((shape[0], n//2 + 1)),            # magnitudes
+                rfftfreq(n, 1/sample_rate)[:n//2],      # frequencies, same as fftfreq[:n//2]
+            )
+        return self._plan[2:]
+
+    def compute(self, signals:list, sample_rate:float) -> tuple:
+        """Mean magnitude spectrum of signals (blocking).
+
+        Args:
+            signals (list): signals of equal length
+            sample_rate (float): sample rate of signals
+
+        Returns:
+            tuple: (frequencies, mean magnitude) of positive frequencies
+        """
+        from scipy.fft import rfft
+
+        y, magnitude, xf = self._buffers((len(signals), len(signals[0])), sample_rate)
+        stack(signals, out=y)
+        absolute(rfft(y, axis=1, workers=self.workers, overwrite_x=True), out=magnitude)
+
+        return xf, mean(magnitude[:, :len(xf)], axis=0)
+
+    def submit(self, signals:list, sample_rate:float):
+        """Compute spectrum on executor thread.
+
+        Returns:
+            concurrent.futures.Future: future of `compute` result
+        """
+        return self._executor.submit(self.compute, list(signals), sample_rate)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
+
+    def __getstate__(self) -> dict:
+        # executor can't be pickled (regulator goes with DeviceManagerProcess)
+        return {'workers': self.workers}
+
+    def __setstate__(self, state:dict) -> None:
+        self.__init__(state['workers'])
+
 class AmplitudeRegulator:
-    def __init__(self, window_length : int, threshold:float=100) -> None:
+    def __init__(self, window_length : int, threshold:float=100,
+                 strategy : ControlStrategy = None, decimator : Decimator = None) -> None:
         """Regulates generator voltage
 
         Args:
             window_length (int): number of signal samples - used for averaging of signal
+            strategy (ControlStrategy, optional): control strategy. Defaults to BisectionStrategy().
+            decimator (Decimator, optional): decimation of signals added with `addSignals`. Defaults to None.
         """
         self.signalRegister   = RollingRegister(window_length)
         self.threshold         = threshold
+        self.strategy          = BisectionStrategy() if strategy is None else strategy
+        self.decimator         = decimator
+
+        # decimation of signals in register and (sample_rate, f0) they were decimated for
+        self.decimationFactor  = 1
+        self._decimationKey    = None
+
+        # generator amplitude signals in register were acquired at, None if unknown
+        self.registerAmplitude = None
+
+        # spectra are computed by spectralEngine, see updateAmplitudeAsync
+        self.spectralEngine    = None
+        self._spectrum         = None   # (future, decimation factor, f0, v0 of register)
+
+        # detection of the last update (telemetry)
+        self.lastMargin        = nan
+        self.lastPeaks         = (nan, nan)  # magnitudes at 3/2 f0 and 5/2 f0
+
+    def addSignals(self, signals, sample_rate : float = None, f0 : float = None,
+                   amplitude : float = None) -> None:
+        """Add signals to register, decimated if decimator is set and
+        sample rate and frequency are known. Register is cleared when
+        decimation or amplitude changes, so it doesn't mix sample rates
+        or operating points.
+
+        Args:
+            signals (Iterable): signals to add
+            sample_rate (float, optional): sample rate of signals. Defaults to None.
+            f0 (float, optional): generator frequency. Defaults to None.
+            amplitude (float, optional): generator amplitude signals were acquired at.
+                Defaults to None (same as signals in register).
+        """
+        if self.decimator is None or sample_rate is None or f0 is None:
+            key, q = None, 1
+        else:
+            key = (sample_rate, f0)
+            q, _ = self.decimator.design(sample_rate, f0)
+            signals = [self.decimator(y, sample_rate, f0)[0] for y in signals]
+
+        if key != self._decimationKey:
+            self.signalRegister.clear()
+            self._decimationKey, self.decimationFactor = key, q
+
+        if amplitude is not None and amplitude != self.registerAmplitude:
+            self.signalRegister.clear()
+            self.registerAmplitude = amplitude
+
+        self.signalRegister.extend(signals)
     
     def updateAmplitude(self, v0 : float, f0 : float,
                         sample_rate : float) -> float:
         """Calculates new voltage peak to peak based on the old one. With all safety features included.
 
         Args:
-            sample_rate (float): sample rate of signals stored in register.
+            sample_rate (float): sample rate of signals before decimation.
             v0 (float): vpp of generator ouput
             f0 (float): frequency of generator ouput
 
@@ -135,9 +603,170 @@ class AmplitudeRegulator:
         if len(self.signalRegister) < 2:
             return v0
         
+        from scipy.fft import fftfreq, fft
+
+        # decimated signals have q times fewer samples, so their spectrum is q
+        # times lower, scale it back to keep threshold meaning
+        q = self.decimationFactor
+        sample_rate = sample_rate / q
+
         y=array(self.signalRegister)
         xf=fftfreq(y.shape[1], 1/sample_rate)[:y.shape[1]//2]
         yf=abs(fft(y, axis=1))[:, :y.shape[1]//2]
-        mean_yf = mean(yf, axis=0)
+        mean_yf = q * mean(yf, axis=0)
+
+        return self.strategy(v0, self.detectionMargin(xf, mean_yf, f0))
+
+    def detectionMargin(self, xf:ArrayLike, yf:ArrayLike, f0:float) -> float:
+        """`subharmonic_margin` of spectrum, remembered with peak magnitudes
+        in lastMargin and lastPeaks.
+        """
+        prominence, peaks = subharmonic_prominence(xf, yf, f0)
+        self.lastMargin = float(prominence.max() - self.threshold)
+        self.lastPeaks  = (float(peaks[0]), float(peaks[1]))
+        return self.lastMargin
+
+    def updateAmplitudeAsync(self, v0 : float, f0 : float,
+                             sample_rate : float) -> float | None:
+        """Non-blocking `updateAmplitude`. Applies spectrum requested on the previous
+        call (if it's ready) and requests spectrum of current register on spectralEngine,
+        so new voltage lags one call behind the register. Only registers acquired
+        entirely at v0 are submitted: after a new voltage is returned (or v0 changed
+        otherwise) the register is refilled at the new voltage first and spectra
+        of the old one are dropped, so every measurement drives one update,
+        computed from (and slew limited against) the voltage it was measured at.
+
+        Args:
+            v0 (float): vpp of generator ouput
+            f0 (float): frequency of generator ouput
+            sample_rate (float): sample rate of signals before decimation.
+
+        Returns:
+            float | None: calculated new vpp, None if no spectrum was ready
+        """
+        if self.spectralEngine is None:
+            self.spectralEngine = SpectralEngine()
+
+        v = None
+        if self._spectrum is not None:
+            future, q, spectrum_f0, measured_v0 = self._spectrum
+            if not future.done():
+                return None
+
+            self._spectrum = None
+            xf, mean_yf = future.result()
+            if spectrum_f0 == f0 and measured_v0 == v0:
+                v = self.strategy(v0, self.detectionMargin(xf, q * mean_yf, f0))
+
+        if v is not None and v != v0:
+            # frames in register were acquired at v0, wait for frames at v
+            self.signalRegister.clear()
+            self.registerAmplitude = v
+            return v
+
+        if self.registerAmplitude != v0:
+            # amplitude was changed elsewhere, register is stale
+            self.signalRegister.clear()
+            self.registerAmplitude = v0
+
+        if len(self.signalRegister) >= 2:
+            q = self.decimationFactor
+            self._spectrum = (
+                self.spectralEngine.submit(self.signalRegister, sample_rate / q), q, f0, v0
+            )
+
+        return v
+
+    def waitSpectrum(self) -> None:
+        """Block until spectrum requested by `updateAmplitudeAsync` is computed
+        (replay on simulated clock).
+        """
+        if self._spectrum is not None:
+            self._spectrum[0].result()
+
+class FrameClassifier:
+    def __init__(self, threshold:float=100, kurtosis_threshold:float=6.,
+                 energy_ratio:float=4., energy_smoothing:float=0.05) -> None:
+        """Tags frames containing bubble activity. Frame is flagged if any of:
+            * subharmonic (3/2 f0, 5/2 f0) peak rises above band floor by more than threshold,
+            * kurtosis exceeds kurtosis_threshold (impulsive signal, collapses),
+            * energy exceeds energy_ratio times running mean energy of quiet frames.
+        Call `configure` with generator frequency and sample rate before classifying.
+
+        Args:
+            threshold (float, optional): subharmonic peak threshold. Defaults to 100.
+            kurtosis_threshold (float, optional): kurtosis threshold, 3 for gaussian noise. Defaults to 6.
+            energy_ratio (float, optional): energy jump ratio. Defaults to 4.
+            energy_smoothing (float, optional): smoothing factor of running mean energy. Defaults to 0.05.
+        """
+        self.threshold          = threshold
+        self.kurtosis_threshold = kurtosis_threshold
+        self.energy_ratio       = energy_ratio
+        self.energy_smoothing   = energy_smoothing
+
+        self.f0             = None
+        self.sample_rate    = None
+        self.mean_energy    = None
+        self.lastMargin     = nan   # subharmonic margin of the last classified frame
+
+    @property
+    def configured(self) -> bool:
+        return self.f0 is not None and self.sample_rate is not None
+
+    def configure(self, f0:float, sample_rate:float) -> None:
+        self.f0             = f0
+        self.sample_rate    = sample_rate
+        self.mean_energy    = None
+
+    def features(self, y:ArrayLike) -> tuple:
+        """Calculates features of frame or block of frames (samples on last axis).
+
+        Args:
+            y (ArrayLike): frame(s)
+
+        Returns:
+            tuple: (subharmonic margin, energy, kurtosis). Margin is the highest
+                subharmonic peak above band floor minus threshold, positive when detected.
+        """
+        from scipy.fft import rfft, rfftfreq
+
+        y = asarray(y)
+        n = y.shape[-1]
+
+        centered = y - y.mean(axis=-1, keepdims=True)
+        variance = (centered**2).mean(axis=-1)
+        energy   = (y**2).mean(axis=-1)
+        kurtosis = (centered**4).mean(axis=-1) / (variance**2 + 1e-300)
+
+        xf = rfftfreq(n, 1/self.sample_rate)
+        yf = abs(rfft(y, axis=-1))
+        peaks, _, floors = band_peaks(xf, yf, (3/2*self.f0, 5/2*self.f0))
+        margin = (peaks - floors).max(axis=-1) - self.threshold
+
+        return margin, energy, kurtosis
+
+    def classify(self, y:ArrayLike) -> bool:
+        """Returns True if frame is 'interesting'. Frames are kept if classifier
+        is not configured.
+        """
+        if not self.configured:
+            self.lastMargin = nan
+            return True
+
+        margin, energy, kurtosis = self.features(y)
+        self.lastMargin = float(margin)
+
+        flagged = bool(
+            margin > 0
+            or kurtosis > self.kurtosis_threshold
+            or (self.mean_energy is not None and energy > self.energy_ratio*self.mean_energy)
+        )
+
+        # running mean follows only quiet frames
+        if not flagged:
+            if self.mean_energy is None:
+                self.mean_energy = float(energy)
+            else:
+                self.mean_energy += self.energy_smoothing*(float(energy) - self.mean_energy)
 
-        return calculate_voltage(v0, xf, mean_yf, f0, self.threshold)
+        return flagged
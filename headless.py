@@ -0,0 +1,224 @@
+"""Headless acquisition daemon.
+
+Runs the same acquisition pipeline as the GUI (session.AcquisitionSession)
+in an asyncio event loop, without Qt. Parameters are read from a json config
+file, the daemon is controlled through a unix socket with one command per line:
+
+    start                   start acquisition
+    stop                    stop acquisition
+    save [path]             save session into archive (acquisition must be stopped)
+    status                  session summary
+    generator on|off        switch generator output
+    quit                    save nothing, close devices and exit
+
+Every command is answered with a single json line, {"ok": true, ...} or
+{"ok": false, "error": "..."}.
+"""
+import asyncio
+import json
+import os
+import signal
+import traceback
+from time import strftime
+
+from known_devices import device_type
+from session import AcquisitionSession
+
+DEFAULT_CONFIG = {
+    'oscilloscope'          : None,     # 'idVendor:idProduct' (hex), first known oscilloscope if None
+    'generator'             : None,     # 'idVendor:idProduct' (hex), first known generator if None
+    'storage_mode'          : 'all',
+    'control_strategy'      : 'bisection',
+    'regulator_decimation'  : False,
+    'memory_cap'            : 1 << 30,
+    'batch_size'            : 8,
+    'update_interval'       : 1.,       # seconds between processing of acquired frames
+    'max_tick_errors'       : 5,        # consecutive failed updates before daemon exits
+    'acquire'               : False,    # start acquisition right after connecting
+    'generator_output'      : False,    # switch generator output on after connecting
+    'stream'                : None,     # streaming server address ('host:port', 'unix:<path>'), None disables it
+    'socket'                : os.path.join(os.path.expanduser('~'), '.cache', 'bubbles_gui', 'headless.sock'),
+    'archive_directory'     : os.path.join(os.path.expanduser('~'), 'bubbles_data'),
+}
+
+def load_config(path : str = None) -> dict:
+    """DEFAULT_CONFIG updated with json config file.
+    """
+    config = dict(DEFAULT_CONFIG)
+    if path is not None:
+        with open(path, 'r') as file:
+            config.update(json.load(file))
+
+    for key in ('socket', 'archive_directory'):
+        config[key] = os.path.expanduser(config[key])
+    return config
+
+def select_device(devices : list, spec : str, kind : str):
+    """Device matching spec ('idVendor:idProduct' in hex, as in connect dialog),
+    first known device of kind ('Osc'/'Gen') if spec is None.
+    """
+    for device in devices:
+        if spec is None:
+            if device_type(device) == kind:
+                return device
+        elif f'{hex(device.idVendor)}:{hex(device.idProduct)}' == spec.lower():
+            return device
+
+    raise LookupError(f'No device found for {kind} ({spec or "first known"}).')
+
+class HeadlessDaemon:
+    def __init__(self, config : dict) -> None:
+        """Acquisition session driven by asyncio loop and control socket.
+
+        Args:
+            config (dict): see DEFAULT_CONFIG
+        """
+        self.config     = config
+        self.session    = AcquisitionSession(
+            storage_mode=config['storage_mode'],
+            control_strategy=config['control_strategy'],
+            regulator_decimation=config['regulator_decimation'],
+            memory_cap=config['memory_cap'],
+            batch_size=config['batch_size'],
+            stream_address=config['stream'],
+        )
+        self.stopped    = asyncio.Event()
+        self.lastError  = None  # last exception of update loop, reported by status
+
+    def connect(self) -> None:
+        from known_devices import known_device_list
+
+        devices, _ = known_device_list()
+        self.session.connect(
+            select_device(devices, self.config['oscilloscope'], 'Osc'),
+            select_device(devices, self.config['generator'], 'Gen'),
+        )
+        self.session.setAcquisition(self.config['acquire'])
+        if self.config['generator_output']:
+            self.session.deviceManager.gen__setattr__('state', True)
+
+    async def run(self) -> None:
+        """Serve control socket and process frames until stopped.
+        """
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stopped.set)
+
+        self.connect()
+
+        socket_path = self.config['socket']
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = await asyncio.start_unix_server(self.handleClient, path=socket_path)
+        print('Listening on:', socket_path)
+
+        ticker = asyncio.create_task(self.tick())
+        try:
+            await self.stopped.wait()
+        finally:
+            ticker.cancel()
+            server.close()
+            await server.wait_closed()
+            os.remove(socket_path)
+            self.session.close()
+
+    async def tick(self) -> None:
+        """Equivalent of MainWindow's updateTimer. Device calls go through pipes
+        which aren't thread safe, so they all run on the loop thread. Failed
+        updates are logged and retried, daemon exits after max_tick_errors
+        consecutive failures instead of serving a session that stopped acquiring.
+        """
+        interval = self.config['update_interval']
+        errors   = 0
+        while not self.stopped.is_set():
+            started = asyncio.get_running_loop().time()
+            try:
+                self.session.supervise()
+                self.session.processFrames()
+                self.reportArchive()
+                errors = 0
+            except Exception as e:
+                errors += 1
+                self.lastError = f'{type(e).__name__}: {e}'
+                print(f'Update failed ({errors}/{self.config["max_tick_errors"]}):')
+                traceback.print_exc()
+                if self.session.deviceSupervisor is None or errors >= self.config['max_tick_errors']:
+                    # device process is gone for good (or keeps failing), exit visibly
+                    print('Stopping daemon.')
+                    self.stopped.set()
+                    return
+
+            elapsed = asyncio.get_running_loop().time() - started
+            await asyncio.sleep(max(0., interval - elapsed))
+
+    def reportArchive(self) -> None:
+        future = self.session.archiveFuture
+        if future != None and future.done():
+            if future.exception() is not None:
+                print('Archive was not written, journal is kept:', future.exception())
+            self.session.archiveFuture, self.session.archiveProgress = None, None
+
+    async def handleClient(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter) -> None:
+        try:
+            while line := await reader.readline():
+                try:
+                    reply = {'ok': True, **self.execute(line.decode().split())}
+                except Exception as e:
+                    reply = {'ok': False, 'error': str(e)}
+
+                writer.write(json.dumps(reply).encode() + b'\n')
+                await writer.drain()
+        except asyncio.CancelledError:
+            # daemon is shutting down, connection is closed below
+            pass
+        finally:
+            writer.close()
+
+    def execute(self, command : list) -> dict:
+        """Execute control command.
+
+        Returns:
+            dict: reply fields
+        """
+        match command:
+            case ['start']:
+                self.session.setAcquisition(True)
+            case ['stop']:
+                self.session.setAcquisition(False)
+            case ['save', *path]:
+                blocker = self.session.saveBlocker()
+                if blocker != None:
+                    raise RuntimeError(' '.join(blocker))
+
+                if path:
+                    dest_archive = os.path.expanduser(path[0])
+                else:
+                    os.makedirs(self.config['archive_directory'], exist_ok=True)
+                    dest_archive = os.path.join(self.config['archive_directory'],
+                                                f"session-{strftime('%Y%m%d-%H%M%S')}.zip")
+                self.session.save(dest_archive)
+                return {'archive': dest_archive}
+            case ['status']:
+                status = self.session.status()
+                status['last_error'] = self.lastError
+                if (progress := self.session.archiveStatus()) != None:
+                    status['archive_progress'] = progress[0]
+                return status
+            case ['generator', ('on' | 'off') as state]:
+                self.session.deviceManager.gen__setattr__('state', state == 'on')
+            case ['quit']:
+                self.stopped.set()
+            case _:
+                raise ValueError(f'Unknown command: {" ".join(command)}')
+        return {}
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Run acquisition without GUI, controlled through unix socket.')
+    parser.add_argument('config', nargs='?', help='json config file, see headless.DEFAULT_CONFIG')
+    args = parser.parse_args()
+
+    daemon = HeadlessDaemon(load_config(args.config))
+    asyncio.run(daemon.run())
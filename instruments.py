@@ -1,4 +1,6 @@
 from typing import Any
+from time import monotonic
+from math import inf
 from usbtmc import Instrument
 
 from numpy import arange, frombuffer, int16
@@ -57,6 +59,34 @@ class Oscilloscope(Instrument):
         x_data = arange(num_points) * x_increment + x_origin - x_reference * x_increment
         return x_data
 
+    def fetch_preamble(self) -> dict:
+        """Fetch waveform preamble (scaling of x and y data) in a single query.
+
+        Returns:
+            dict: points, x_increment, x_origin, x_reference, y_increment, y_origin, y_reference
+        """
+        # format, type, points, count, xincrement, xorigin, xreference, yincrement, yorigin, yreference
+        fields = self.ask(':WAV:PRE?').split(',')
+
+        return {
+            'points'        : int(float(fields[2])),
+            'x_increment'   : float(fields[4]),
+            'x_origin'      : float(fields[5]),
+            'x_reference'   : float(fields[6]),
+            'y_increment'   : float(fields[7]),
+            'y_origin'      : float(fields[8]),
+            'y_reference'   : float(fields[9]),
+        }
+
+    def fetch_trigger_time(self) -> float:
+        """Fetch trigger time tag of the last acquisition, time from the first
+        segment in segmented memory mode.
+
+        Returns:
+            float: time tag in seconds
+        """
+        return float(self.ask(':WAV:SEGM:TTAG?'))
+
     def fetch_y_data(self):
         """Fetch Y-axis data (voltage data) from the oscilloscope for a specified channel.
 
@@ -87,6 +117,11 @@ class Oscilloscope(Instrument):
 class Generator(Instrument):
     """Initiates communication with tektronix AFG3102 generator.
 
+    Amplitude, frequency and state are cached (write-through). Writes of values
+    equal to cached ones are skipped and writes following each other faster than
+    `min_write_interval` are coalesced - only the latest value is written by `flush`.
+    Reads are served from cache and re-queried after `verify_interval`.
+
     Args:
         Instrument (class): USBTMC instrument interface client
 
@@ -94,13 +129,74 @@ class Generator(Instrument):
         TypeError: in __setattr__: Attribute 'amplitude' must be a float or convertible to float.
         TypeError: in __setattr__: Attribute 'state' must be a bool or convertible to bool.
     """
-    def __init__(self, *args, timeout=2, output_channel : int=1, **kwargs):
+    # attributes served from cache
+    cached_attributes = ('amplitude', 'frequency', 'state')
+
+    def __init__(self, *args, timeout=2, output_channel : int=1,
+                 verify_interval : float=5., min_write_interval : float=0.1, **kwargs):
         super().__init__(*args, **kwargs)
         
         self.timeout = timeout
         self._output_channel=output_channel
+        self._cache     = {}    # name -> (value, time of write/read)
+        self._pending   = {}    # name -> value waiting for flush
+        self._last_write        = {}    # name -> time of last write
+        self.verify_interval    = verify_interval
+        self.min_write_interval = min_write_interval
         self.write('*CLS')  # Clear the status
 
+    def _write_cached(self, name: str, value: Any) -> None:
+        """Write value to instrument unless it's already there. Writes
+        faster than min_write_interval are deferred to `flush`.
+        """
+        cached = self._cache.get(name)
+        if cached is not None and cached[0] == value and name not in self._pending:
+            return
+
+        now = monotonic()
+        if now - self._last_write.get(name, -inf) < self.min_write_interval:
+            self._pending[name] = value
+            return
+
+        self._pending.pop(name, None)
+        match name:
+            case 'amplitude':
+                self.write(f':source{self._output_channel}:voltage:amplitude {value:.3f}')
+            case 'state':
+                if value:
+                    self.write(f':output{self._output_channel}:state on')
+                else:
+                    self.write(f':output{self._output_channel}:state off')
+
+        self._last_write[name]  = now
+        self._cache[name]       = (value, now)
+
+    def flush(self) -> None:
+        """Write pending (coalesced) values which waited at least min_write_interval.
+        """
+        for name, value in list(self._pending.items()):
+            if monotonic() - self._last_write.get(name, -inf) >= self.min_write_interval:
+                del self._pending[name]
+                # pending value may equal the cached one after coalescing
+                cached = self._cache.get(name)
+                if cached is None or cached[0] != value:
+                    self._write_cached(name, value)
+
+    def applied(self, name : str) -> Any:
+        """Value in effect on instrument (last written or read, pending writes
+        excluded), None if unknown. Doesn't query instrument.
+        """
+        cached = self._cache.get(name)
+        return None if cached is None else cached[0]
+
+    def invalidate(self, name : str = None) -> None:
+        """Drop cached value(s), next read will query instrument.
+        """
+        if name is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(name, None)
+
     def __setattr__(self, name: str, value: Any) -> None:
         # specific procedures to do before setting variable
         match name:
@@ -112,7 +208,9 @@ class Generator(Instrument):
                     except ValueError:
                         raise TypeError(f"Attribute 'amplitude' must be a float or convertible to float.")
 
-                self.write(f':source{self._output_channel}:voltage:amplitude {value:.3f}')
+                # instrument gets 3 decimal places, compare what is actually written
+                value = round(value, 3)
+                self._write_cached('amplitude', value)
             case 'state':
                 # make sure it's bool
                 if not isinstance(value, bool):
@@ -121,24 +219,35 @@ class Generator(Instrument):
                     except ValueError:
                         raise TypeError("Attribute 'state' must be a bool or convertible to bool.")
 
-                if value:
-                    self.write(f':output{self._output_channel}:state on')
-                else:
-                    self.write(f':output{self._output_channel}:state off')
+                self._write_cached('state', value)
         
         super().__setattr__(name, value)
     
     def __getattr__(self, name: str) -> Any:
+        # serve from cache, pending value is the latest one
+        if name in Generator.cached_attributes:
+            pending = self.__dict__.get('_pending', {})
+            cached  = self.__dict__.get('_cache', {}).get(name)
+            if name in pending:
+                return pending[name]
+            if cached is not None and monotonic() - cached[1] < self.verify_interval:
+                return cached[0]
+
         # specific procedures to do before returning variable
         match name:
             case 'instrument_name':
                 return self.ask('*IDN?')
             case 'frequency':
-                return float(self.ask(f':source{self._output_channel}:frequency?'))
+                value = float(self.ask(f':source{self._output_channel}:frequency?'))
             case 'amplitude':
-                return float(self.ask(f':source{self._output_channel}:voltage:amplitude?'))
+                value = float(self.ask(f':source{self._output_channel}:voltage:amplitude?'))
             case 'state':
-                return True if self.ask(f':output{self._output_channel}:state?') == '1' else False
+                value = True if self.ask(f':output{self._output_channel}:state?') == '1' else False
+            case _:
+                return None
+
+        self._cache[name] = (value, monotonic())
+        return value
 
 def calculate_peak_voltage(target_pressure):
     pass
\ No newline at end of file
@@ -0,0 +1,329 @@
+"""Append-only acquisition journal.
+
+Journal file consists of a 64 byte file header followed by fixed-size records:
+
+    file header : magic (8s), version (H), itemsize (H), record_length (I), created (d), padding
+    record      : marker (I), sequence (Q), timestamp (d), acquisition (q), trigger_time (d),
+                  transfer_time (d), crc32 (I), payload (record_length * itemsize)
+
+sequence numbers stored frames, acquisition numbers all acquired frames (see
+workers.Frame), timestamp is host time.monotonic() of the trigger. Version 1
+records (marker, sequence, timestamp, crc32) are still readable.
+crc32 covers all record fields but marker and crc32, and payload. Records are fsync'ed in batches,
+so after a crash the journal holds every batch written before it, possibly
+followed by a torn record. Session metadata is kept in a json sidecar
+(`<journal>.json`) written when the session starts.
+"""
+import json
+import os
+import re
+import struct
+import zlib
+from glob import glob
+from math import nan
+from time import time, monotonic, strftime
+
+from numpy import float64, frombuffer, ascontiguousarray, arange, array, dtype
+from numpy.typing import NDArray
+
+from telemetry import telemetry_directory, read_schema, telemetry_members, remove_telemetry
+
+JOURNAL_DIR     = os.path.join(os.path.expanduser('~'), '.cache', 'bubbles_gui', 'journal')
+RECOVERED_DIR   = os.path.join(os.path.expanduser('~'), '.cache', 'bubbles_gui', 'recovered')
+
+MAGIC           = b'BBLJRNL\x00'
+VERSION         = 2
+FILE_HEADER     = struct.Struct('<8sHHId')
+FILE_HEADER_SIZE= 64
+RECORD_HEADERS  = {1: struct.Struct('<IQdI'), 2: struct.Struct('<IQdqddI')}
+RECORD_HEADER   = RECORD_HEADERS[VERSION]
+RECORD_MARKER   = 0xB0BB1E50
+
+# side array of archive frames (frames.bin), one item per stored frame
+FRAME_INFO      = dtype([('acquisition', '<i8'), ('timestamp', '<f8'),
+                         ('trigger_time', '<f8'), ('transfer_time', '<f8')])
+
+
+def new_journal_path(directory : str = JOURNAL_DIR) -> str:
+    """Returns path of a new journal file named after current time.
+    """
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"session-{strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.journal")
+
+def journal_pid(journal_path : str) -> int | None:
+    """PID of the process which wrote journal (from its name, see new_journal_path).
+    """
+    match = re.search(r'-(\d+)\.journal$', os.path.basename(journal_path))
+    return None if match is None else int(match.group(1))
+
+def pid_alive(pid : int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # process of another user
+        return True
+    return True
+
+def list_journals(directory : str = JOURNAL_DIR) -> list:
+    """Returns journals left in directory (sessions which weren't saved). Journals
+    of running processes (other instances still acquiring into them) are skipped.
+    """
+    return sorted(
+        journal_path for journal_path in glob(os.path.join(directory, '*.journal'))
+        if (pid := journal_pid(journal_path)) is None or not pid_alive(pid)
+    )
+
+def record_size(record_length : int, itemsize : int = 8, version : int = VERSION) -> int:
+    return RECORD_HEADERS[version].size + record_length * itemsize
+
+def write_session_metadata(journal_path : str, metadata : dict) -> None:
+    """Writes session metadata sidecar of the journal.
+    """
+    with open(journal_path + '.json', 'w') as file:
+        json.dump(metadata, file, indent=4)
+        file.flush()
+        os.fsync(file.fileno())
+
+def read_session_metadata(journal_path : str) -> dict:
+    try:
+        with open(journal_path + '.json', 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def remove_journal(journal_path : str) -> None:
+    for path in (journal_path, journal_path + '.json'):
+        if os.path.exists(path):
+            os.remove(path)
+    remove_telemetry(telemetry_directory(journal_path))
+
+def append_journal(journal_path : str, data_list : list, first_sequence : int,
+                   frame_info : list = None) -> int:
+    """Appends batch of frames to journal and fsyncs it. Journal header is
+    written on first call, record length is taken from the first frame.
+    Frames of different length are skipped.
+
+    Args:
+        journal_path (str): path to journal file
+        data_list (list): list of numpy arrays (float64)
+        first_sequence (int): sequence number of the first frame in batch
+        frame_info (list, optional): (acquisition, timestamp, trigger_time, transfer_time)
+            of frames. Defaults to None (unknown acquisition and time of writing).
+
+    Returns:
+        int: number of written records
+    """
+    if not data_list:
+        return 0
+
+    if frame_info is None:
+        frame_info = [(-1, monotonic(), nan, nan)] * len(data_list)
+
+    written = 0
+    with open(journal_path, 'ab') as file:
+        if file.tell() == 0:
+            record_length = len(data_list[0])
+            file.write(
+                FILE_HEADER.pack(MAGIC, VERSION, 8, record_length, time())
+                .ljust(FILE_HEADER_SIZE, b'\x00')
+            )
+        else:
+            with open(journal_path, 'rb') as header_file:
+                _, version, _, record_length, _ = FILE_HEADER.unpack(
+                    header_file.read(FILE_HEADER.size)
+                )
+            if version != VERSION:
+                raise ValueError(f'Journal {journal_path} version {version} can not be appended.')
+            # drop torn record left by a crash, so records stay aligned
+            misalignment = (file.tell() - FILE_HEADER_SIZE) % record_size(record_length)
+            if misalignment:
+                file.truncate(file.tell() - misalignment)
+                file.seek(0, os.SEEK_END)
+
+        for sequence, (y, info) in enumerate(zip(data_list, frame_info), first_sequence):
+            if len(y) != record_length:
+                print(f'Journal: frame {sequence} skipped, length {len(y)} != {record_length}')
+                continue
+
+            payload = ascontiguousarray(y, dtype=float64).tobytes()
+            fields  = (sequence, info[1], info[0], info[2], info[3])
+            crc     = zlib.crc32(payload, zlib.crc32(_record_fields(VERSION, fields)))
+
+            file.write(RECORD_HEADER.pack(RECORD_MARKER, *fields, crc))
+            file.write(payload)
+            written += 1
+
+        file.flush()
+        os.fsync(file.fileno())
+
+    return written
+
+def _record_fields(version : int, fields : tuple) -> bytes:
+    """Packed record fields covered by crc32.
+    """
+    return struct.pack('<Qd' if version == 1 else '<Qdqdd', *fields)
+
+def read_journal(journal_path : str, chunk_records : int = 64):
+    """Yields valid records of journal in one linear pass. Records with broken
+    marker or checksum are skipped, torn record at the end is ignored.
+
+    Args:
+        journal_path (str): path to journal file
+        chunk_records (int, optional): records read at once. Defaults to 64.
+
+    Yields:
+        tuple: (sequence, (acquisition, timestamp, trigger_time, transfer_time), y).
+            Version 1 records have unknown (-1) acquisition and nan times but timestamp.
+    """
+    with open(journal_path, 'rb') as file:
+        header = file.read(FILE_HEADER_SIZE)
+        if len(header) < FILE_HEADER_SIZE:
+            return
+
+        magic, version, itemsize, record_length, _ = FILE_HEADER.unpack(header[:FILE_HEADER.size])
+        if magic != MAGIC or version not in RECORD_HEADERS:
+            raise ValueError(f'{journal_path} is not a journal file.')
+
+        record_header = RECORD_HEADERS[version]
+        size = record_size(record_length, itemsize, version)
+        while chunk := file.read(size * chunk_records):
+            for offset in range(0, len(chunk) - size + 1, size):
+                marker, *fields, crc = record_header.unpack_from(chunk, offset)
+                payload = chunk[offset + record_header.size : offset + size]
+
+                if marker != RECORD_MARKER:
+                    continue
+                if zlib.crc32(payload, zlib.crc32(_record_fields(version, fields))) != crc:
+                    continue
+
+                if version == 1:
+                    info = (-1, fields[1], nan, nan)
+                else:
+                    info = (fields[2], fields[1], fields[3], fields[4])
+                yield fields[0], info, frombuffer(payload, dtype=float64)
+
+def journal_to_binary_file(journal_path : str, dest_file : str, info_file : str = None) -> int:
+    """Rebuilds raw ydata binary file (frames concatenated) from journal.
+    Frames are written in sequence order, duplicates are dropped.
+
+    Args:
+        journal_path (str): path to journal file
+        dest_file (str): path of ydata binary file
+        info_file (str, optional): path of FRAME_INFO side array. Defaults to None (not written).
+
+    Returns:
+        int: number of recovered frames
+    """
+    recovered, last_sequence, frame_info = 0, -1, []
+    with open(dest_file, 'wb') as file:
+        for sequence, info, y in read_journal(journal_path):
+            if sequence <= last_sequence:
+                continue
+            file.write(y.tobytes())
+            frame_info.append(info)
+            last_sequence = sequence
+            recovered += 1
+
+    if info_file is not None:
+        array(frame_info, dtype=FRAME_INFO).tofile(info_file)
+
+    return recovered
+
+def x_data_from_metadata(metadata : dict) -> NDArray:
+    """Rebuilds x data from 'x_origin' and 'x_increment' of scope metadata.
+    """
+    scope = metadata.get('scope', {})
+    if 'x_increment' not in scope:
+        return arange(0)
+    return arange(scope['record_length']) * scope['x_increment'] + scope['x_origin']
+
+def journal_to_archive(journal_path : str, dest_archive : str, metadata : dict = None,
+                       x_data_array : NDArray = None, **kwargs) -> int:
+    """Writes archive (see save_file.write_archive_xy) from journal and its
+    telemetry and removes them. Metadata and x data default to the ones from
+    the journal sidecar.
+    kwargs are passed to write_archive_xy (compresslevel, workers, progress).
+
+    Returns:
+        int: number of frames in archive
+    """
+    from save_file import write_archive_xy
+
+    if metadata is None:
+        metadata = read_session_metadata(journal_path)
+    if x_data_array is None:
+        x_data_array = x_data_from_metadata(metadata)
+
+    ydata_path = journal_path + '.ydata'
+    info_path  = journal_path + '.frames'
+    recovered = journal_to_binary_file(journal_path, ydata_path, info_path)
+    metadata['frames'] = recovered
+
+    # acquisition numbers and times of frames are stored in frames.bin
+    metadata['frame_info'] = {
+        'dtype' : [(name, FRAME_INFO[name].str) for name in FRAME_INFO.names],
+    }
+    extra_files = {'frames.bin': info_path}
+
+    # telemetry of the session is bundled as telemetry/<column>.bin
+    directory = telemetry_directory(journal_path)
+    if os.path.isdir(directory):
+        metadata['telemetry'] = read_schema(directory)
+        extra_files.update(telemetry_members(directory))
+
+    write_archive_xy(metadata, x_data_array, ydata_path, dest_archive,
+                     extra_files=extra_files, **kwargs)
+    os.remove(info_path)
+    remove_journal(journal_path)
+
+    return recovered
+
+def recover_journals(journals : list = None, dest_directory : str = RECOVERED_DIR) -> list:
+    """Recovers journals into archives.
+
+    Args:
+        journals (list, optional): journal paths. Defaults to None (all journals in JOURNAL_DIR).
+        dest_directory (str, optional): directory of recovered archives. Defaults to RECOVERED_DIR.
+
+    Returns:
+        list: paths of recovered archives
+    """
+    os.makedirs(dest_directory, exist_ok=True)
+
+    archives = []
+    for journal_path in list_journals() if journals is None else journals:
+        name = os.path.basename(journal_path).replace('.journal', '')
+        dest_archive = os.path.join(dest_directory, f'{name}.zip')
+        journal_to_archive(journal_path, dest_archive)
+        archives.append(dest_archive)
+
+    return archives
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Recover archives from acquisition journals.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('list', help='list journals of unsaved sessions')
+
+    recover_parser = subparsers.add_parser('recover', help='rebuild archive from journal')
+    recover_parser.add_argument('journal', nargs='?', help='journal file, all journals if omitted')
+    recover_parser.add_argument('archive', nargs='?', help='destination archive (.zip)')
+
+    args = parser.parse_args()
+
+    match args.command:
+        case 'list':
+            for journal_path in list_journals():
+                print(journal_path)
+        case 'recover':
+            if args.journal is None:
+                for archive in recover_journals():
+                    print(archive)
+            else:
+                archive = args.archive or args.journal.replace('.journal', '') + '.zip'
+                frames = journal_to_archive(args.journal, archive)
+                print(f'Recovered {frames} frames into: {archive}')
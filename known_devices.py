@@ -1,3 +1,8 @@
+import json
+import os
+import threading
+from time import monotonic
+
 # set of known oscilloscope idVendor and idProduct
 knownOscilloscopes = {
     ('0x957', '0x900d'), 
@@ -8,6 +13,74 @@ knownGenerators = {
     ('0x699', '0x343'),
 }
 
+# user registry of additional devices, see load_registry
+USER_REGISTRY_PATH = os.path.join(
+    os.path.expanduser('~'), '.config', 'bubbles_gui', 'known_devices.json'
+)
+
+def _device_ids(idVendor, idProduct) -> tuple:
+    return tuple(
+        hex(int(i, 16)) if isinstance(i, str) else hex(i)
+        for i in (idVendor, idProduct)
+    )
+
+def register_device(idVendor, idProduct, kind : str) -> None:
+    """Adds device to the set of known devices.
+
+    Args:
+        idVendor (int | str): vendor id, int or hex string ('0x957')
+        idProduct (int | str): product id, int or hex string ('0x900d')
+        kind (str): 'Osc' or 'Gen'
+
+    Raises:
+        ValueError: kind is neither 'Osc' nor 'Gen'
+    """
+    ids = _device_ids(idVendor, idProduct)
+    match kind:
+        case 'Osc':
+            knownOscilloscopes.add(ids)
+        case 'Gen':
+            knownGenerators.add(ids)
+        case _:
+            raise ValueError(f"Unknown device kind '{kind}', expected 'Osc' or 'Gen'.")
+
+def load_registry(path : str = USER_REGISTRY_PATH) -> int:
+    """Loads user registry of devices. Registry is a json list of objects:
+    [{"idVendor": "0x957", "idProduct": "0x900d", "kind": "Osc"}, ...]
+    Nothing is registered if any of the entries is invalid.
+
+    Args:
+        path (str, optional): path to json file. Defaults to USER_REGISTRY_PATH.
+
+    Raises:
+        OSError: registry can't be read
+        ValueError: registry isn't valid json or has invalid entries
+
+    Returns:
+        int: number of registered devices
+    """
+    if not os.path.isfile(path):
+        return 0
+
+    with open(path, 'r') as file:
+        entries = json.load(file)
+
+    try:
+        devices = [
+            (_device_ids(entry['idVendor'], entry['idProduct']), entry['kind'])
+            for entry in entries
+        ]
+    except (KeyError, TypeError) as e:
+        raise ValueError(f'Invalid registry entry: {e!r}') from e
+    for _, kind in devices:
+        if kind not in ('Osc', 'Gen'):
+            raise ValueError(f"Unknown device kind '{kind}', expected 'Osc' or 'Gen'.")
+
+    for ids, kind in devices:
+        register_device(*ids, kind)
+
+    return len(devices)
+
 def device_type(device) -> str:
     ids = (hex(device.idVendor), hex(device.idProduct))
 
@@ -18,6 +91,36 @@ def device_type(device) -> str:
     
     return 'UknDev'
 
+def device_key(device) -> tuple:
+    """Key identifying device across enumerations: (idVendor, idProduct, serial).
+    Serial number is read from string descriptor which requires permissions to
+    the device, if that fails bus and address are used instead.
+    """
+    try:
+        serial = device.serial_number
+    except Exception:
+        serial = None
+
+    if serial is None:
+        serial = f'bus{device.bus}:{device.address}'
+
+    return (hex(device.idVendor), hex(device.idProduct), serial)
+
+def query_instrument_name(device) -> str | None:
+    """Ask device for '*IDN?'. Returns None if device doesn't respond.
+    """
+    from usbtmc import Instrument
+
+    try:
+        instrument = Instrument(device)
+        instrument.timeout = 1
+        try:
+            return instrument.ask('*IDN?')
+        finally:
+            instrument.close()
+    except Exception:
+        return None
+
 def known_device_list() -> tuple:
     from usbtmc import list_devices
     devices=list_devices()
@@ -29,3 +132,143 @@ def known_device_list() -> tuple:
             for dev in devices
         ]
     )
+
+class DeviceDiscovery(threading.Thread):
+    """Background device discovery. Enumerates usbtmc devices once, caches them
+    keyed by `device_key` and resolves '*IDN?' names of known devices. Cache is
+    updated on hot-plug events (pyudev if installed) or by periodic rescan.
+
+    Name resolution happens only once per device and never for devices passed
+    to `claim`, so devices opened by DeviceManagerProcess aren't queried.
+    """
+    def __init__(self, rescan_interval : float = 5.0, resolve_names : bool = True) -> None:
+        super().__init__(daemon=True)
+        self.rescan_interval = rescan_interval
+        self.resolve_names   = resolve_names
+
+        self._lock          = threading.Lock()
+        self._devices       = {}    # device_key -> usb device
+        self._names         = {}    # device_key -> '*IDN?' response
+        self._claimed       = set() # device_keys of devices in use, never queried
+        self._querying      = None  # device_key of device being queried
+        self._query_done    = threading.Condition(self._lock)
+        self._rescan_event  = threading.Event()
+        self._stop_event    = threading.Event()
+        self.ready          = threading.Event()   # set once devices were enumerated
+        self.last_scan      = None
+
+        # broken registry mustn't prevent startup, built-in devices are still known
+        try:
+            load_registry()
+        except (OSError, ValueError) as e:
+            print(f'Registry of known devices {USER_REGISTRY_PATH} ignored:', e)
+
+    def run(self):
+        monitor = self._udev_monitor()
+
+        while not self._stop_event.is_set():
+            try:
+                self.scan()
+            except Exception as e:
+                print('Device discovery failed:', e)
+            self.ready.set()
+
+            if monitor is not None:
+                # block until usb event, timeout keeps thread responsive to stop
+                while not self._stop_event.is_set() and not self._rescan_event.is_set():
+                    if monitor.poll(timeout=self.rescan_interval) is not None:
+                        break
+            else:
+                self._rescan_event.wait(self.rescan_interval)
+            self._rescan_event.clear()
+
+    def _udev_monitor(self):
+        try:
+            from pyudev import Context, Monitor
+        except ImportError:
+            return None
+
+        monitor = Monitor.from_netlink(Context())
+        monitor.filter_by(subsystem='usb')
+        monitor.start()
+        return monitor
+
+    def scan(self) -> None:
+        """Enumerate devices and update cache. Names are resolved only for
+        newly connected devices.
+        """
+        from usbtmc import list_devices
+
+        current = {device_key(dev): dev for dev in list_devices()}
+
+        with self._lock:
+            new_keys = current.keys() - self._devices.keys()
+            self._devices = current
+            for key in self._names.keys() - current.keys():
+                del self._names[key]
+        # devices are listed before their names are resolved ('*IDN?' may take seconds)
+        self.ready.set()
+
+        if self.resolve_names:
+            for key in new_keys:
+                if device_type(current[key]) == 'UknDev':
+                    continue
+                with self._lock:
+                    if key in self._claimed:
+                        continue
+                    self._querying = key
+                try:
+                    name = query_instrument_name(current[key])
+                finally:
+                    with self._lock:
+                        self._querying = None
+                        self._query_done.notify_all()
+                with self._lock:
+                    if key in self._devices and name is not None:
+                        self._names[key] = name
+
+        self.last_scan = monotonic()
+
+    def claim(self, *devices) -> None:
+        """Exclude devices from name resolution before they're opened elsewhere.
+        Blocks while one of them is being queried (at most a few seconds).
+        """
+        keys = {device_key(dev) for dev in devices if dev is not None}
+        with self._lock:
+            self._claimed |= keys
+            self._query_done.wait_for(lambda: self._querying not in keys)
+
+    def rescan(self) -> None:
+        """Request immediate rescan.
+        """
+        self._rescan_event.set()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._rescan_event.set()
+
+    def known_device_list(self, timeout : float = None) -> tuple:
+        """Cached equivalent of `known_device_list`.
+
+        Args:
+            timeout (float, optional): time to wait for the first enumeration. Defaults
+                to None (wait forever), GUI should pass a short timeout and show what is cached.
+
+        Returns:
+            tuple: list of devices and list of their descriptions
+        """
+        self.ready.wait(timeout)
+
+        with self._lock:
+            keys    = sorted(self._devices)
+            devices = [self._devices[key] for key in keys]
+            names   = [self._names.get(key) for key in keys]
+
+        return (
+            devices,
+            [
+                f'{hex(dev.idVendor)}:{hex(dev.idProduct)} {device_type(dev)}' \
+                + (f' {name}' if name else '')
+                for dev, name in zip(devices, names)
+            ]
+        )
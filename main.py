@@ -1,10 +1,28 @@
+from time import perf_counter
+_t_start = perf_counter()
+
 from PyQt6.QtWidgets import QApplication
+from PyQt6.QtCore import QTimer
 from main_window import MainWindow
 
+from threading import Thread
+
+def report_startup_profile():
+    """Print time from interpreter start to window shown and list heavy
+    modules that were loaded before window was drawn.
+    """
+    import sys
+
+    print(f'Window shown after: {perf_counter() - _t_start:.3f} s')
+    for module in ('scipy', 'usbtmc', 'usb', 'numpy'):
+        print(f'{module:>8} loaded: {module in sys.modules}')
+
 if __name__ == '__main__':
 
     import sys
 
+    profile_startup = '--profile-startup' in sys.argv
+
     app = QApplication(sys.argv)
 
     # Define the style sheet
@@ -19,4 +37,14 @@ if __name__ == '__main__':
 
     main = MainWindow()
     main.show()
+
+    if profile_startup:
+        # report after first paint and exit
+        QTimer.singleShot(0, report_startup_profile)
+        QTimer.singleShot(0, main.close)
+    else:
+        # load scipy, usb stacks and manager server while user looks at the window
+        from workers import preload_modules
+        QTimer.singleShot(0, Thread(target=preload_modules, daemon=True).start)
+
     sys.exit(app.exec())
\ No newline at end of file
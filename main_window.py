@@ -1,12 +1,13 @@
-from tempfile import NamedTemporaryFile, TemporaryDirectory
-
-from known_devices import known_device_list
+from known_devices import DeviceDiscovery
 from window_base import ConnectionDialog, MainWindowBase
-from workers import DeviceManagerProcess
-from save_file import list_to_binary_file, write_archive_xy
+from journal import list_journals, recover_journals, RECOVERED_DIR
+from session import AcquisitionSession
+from streaming import DEFAULT_ADDRESS
 
-from concurrent.futures import ProcessPoolExecutor
+from PyQt6.QtCore import QTimer
+from PyQt6.QtWidgets import QMessageBox
 
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 def float_to_eng(number:float, digits:int=4):
     return Decimal(round(number, digits)).normalize().to_eng_string()
@@ -16,12 +17,18 @@ class MainWindow(MainWindowBase):
         """Main window of the program. Connecting logic to buttons from MainWindowBase.
         """
         super().__init__()
-        self.tempDataDir        = TemporaryDirectory()
-        self.tempDataFile       = NamedTemporaryFile(dir=self.tempDataDir.name, delete=False)
-        self.tempDataAcquired   = False
+        # journals of sessions which weren't saved (previous crash), recovered
+        # in background so journal writes of the new session aren't blocked
+        self.leftoverJournals   = list_journals()
+        self.recoveryExecutor   = ThreadPoolExecutor(max_workers=1)
+        self.recoveryFuture     = None
 
+        # acquisition pipeline, shared with headless mode
+        self.session            = AcquisitionSession()
 
-        self.deviceManager  = None
+        # enumerate devices in background, so connect dialog opens instantly
+        self.deviceDiscovery = DeviceDiscovery()
+        self.deviceDiscovery.start()
 
         self.generatorGroupBox.connectionButton.clicked.connect(
             self.changeGeneratorState
@@ -30,10 +37,49 @@ class MainWindow(MainWindowBase):
             self.changeOscilloscopeState
         )
 
-        self.poolExecutor = ProcessPoolExecutor(max_workers=1)
+        if self.leftoverJournals:
+            QTimer.singleShot(0, self.offerJournalRecovery)
+
+    def offerJournalRecovery(self):
+        """Ask user whether to recover sessions left unsaved by previous run.
+        """
+        answer = QMessageBox.question(
+            self, 'Unsaved sessions found',
+            (f'Found {len(self.leftoverJournals)} unsaved session(s) from previous run.'
+             f' Recover them into {RECOVERED_DIR}?')
+        )
+        if answer == QMessageBox.StandardButton.Yes:
+            self.recoveryFuture = self.recoveryExecutor.submit(recover_journals, self.leftoverJournals)
+
+    def updateJournalRecovery(self):
+        """Report result of journal recovery once it's finished.
+        """
+        if self.recoveryFuture == None or not self.recoveryFuture.done():
+            return
+
+        error = self.recoveryFuture.exception()
+        if error is not None:
+            self.showErrorMessageBox(error, 'Recovery failed, remaining journals are kept,'
+                                            ' recover them with `python journal.py recover`.')
+        else:
+            QMessageBox.information(
+                self, 'Sessions recovered',
+                f'Recovered {len(self.recoveryFuture.result())} session(s) into {RECOVERED_DIR}.'
+            )
+        self.recoveryFuture = None
+
+    @property
+    def deviceManager(self):
+        return self.session.deviceManager
+
+    @property
+    def deviceSupervisor(self):
+        return self.session.deviceSupervisor
 
     def initDevices(self, deviceOsc, deviceGen):
-        self.deviceManager = DeviceManagerProcess(deviceOsc, deviceGen, autostart=True)
+        # discovery mustn't talk to devices owned by device process
+        self.deviceDiscovery.claim(deviceOsc, deviceGen)
+        self.session.connect(deviceOsc, deviceGen)
 
         # Fetch generator name
         generatorName=self.deviceManager.gen__getattr__('instrument_name')
@@ -61,12 +107,23 @@ class MainWindow(MainWindowBase):
         )
 
     def connectDevicesDialog(self):
-        # get device
-        device_list, str_items=known_device_list()
+        # get devices cached by discovery, don't block on the first scan
+        device_list, str_items=self.deviceDiscovery.known_device_list(timeout=0.5)
         dialog=ConnectionDialog(self,
             item_list=str_items
         )
 
+        # list follows discovery (rescan, hot-plug, resolved names) while dialog is open
+        def refresh():
+            nonlocal device_list
+            device_list, str_items=self.deviceDiscovery.known_device_list(timeout=0)
+            dialog.setItems(str_items)
+
+        refreshTimer=QTimer(dialog)
+        refreshTimer.timeout.connect(refresh)
+        refreshTimer.start(500)
+        dialog.rescanButton.clicked.connect(self.deviceDiscovery.rescan)
+
         dialog.buttonBox.accepted.connect(
             lambda: self.initDevices(
                 device_list[dialog.comboOsc.currentIndex()] if len(device_list) else None,
@@ -75,6 +132,7 @@ class MainWindow(MainWindowBase):
         )
         
         dialog.exec()
+        refreshTimer.stop()
 
     def changeGeneratorState(self):
         """Button logic for generatorGroupBox.connectionButton. Connects
@@ -83,7 +141,7 @@ class MainWindow(MainWindowBase):
         if self.deviceManager == None:
             self.connectDevicesDialog()
 
-        if self.deviceManager != None:
+        if self.session.devicesReady:
             # Fetch generator state
             newGeneratorState = not self.deviceManager.gen__getattr__('state')
             self.deviceManager.gen__setattr__('state', newGeneratorState)
@@ -104,109 +162,109 @@ class MainWindow(MainWindowBase):
         if self.deviceManager == None:
             self.connectDevicesDialog()
         
-        if self.deviceManager != None:
-            self.oscilloscopeGroupBox.connectionButton.updateLabels(
-                not self.deviceManager.pause_event.is_set()
-            )
+        if self.session.devicesReady:
+            acquiring = self.session.acquiring
+            self.oscilloscopeGroupBox.connectionButton.updateLabels(not acquiring)
 
-            # Update sample rate
+            self.session.setAcquisition(not acquiring)
             self.oscilloscopeGroupBox.updateWidgets(
-                acquisition_state=not self.deviceManager.pause_event.is_set(),
-                sample_rate=float_to_eng(self.deviceManager.osc__getattr__('analog_sample_rate'))
+                acquisition_state=not acquiring,
+                sample_rate=float_to_eng(self.session.sampleRate)
             )
 
-            self.deviceManager.togglePause()
+    def superviseDevices(self):
+        """Restart device process if it died.
+        """
+        try:
+            self.session.supervise()
+        except Exception as e:
+            # exceptions must not reach Qt timer slot, PyQt6 aborts on them
+            self.showErrorMessageBox(e, 'Reconnect devices and try again.')
 
     def updateWidgets(self):
         """Updates widget display Generator and Oscilloscope (if connected).
         Some display values are slow to fetch from deviced like
         `analog_sample_rate`, so they're not updated every frame.
         """
-        if self.deviceManager != None:
+        # device process is restarted by superviseDevices, its calls would fail
+        if self.session.devicesReady:
             self.generatorGroupBox.updateWidgets(
                 frequency=float_to_eng(self.deviceManager.gen__getattr__('frequency')),
                 amplitude=round(self.deviceManager.gen__getattr__('amplitude'), 4)
             )
+
+        self.updateArchiveProgress()
+        self.updateJournalRecovery()
+
+        if self.deviceSupervisor != None:
+            self.statusBar().showMessage(
+                f"Frames: {self.deviceSupervisor.statistic('frames'):.0f}"
+                f"  Faults: {self.deviceSupervisor.statistic('faults'):.0f}"
+                f"  Restarts: {self.deviceSupervisor.statistic('restarts'):.0f}"
+                f"  Trigger rate: {self.session.rateMeter.rate:.1f} Hz"
+                f"  Dead time: {100 * self.session.rateMeter.deadTime:.0f}%"
+                f"  Downtime: {self.deviceSupervisor.statistic('downtime'):.1f} s"
+                f"  {self.session.memoryBudget.report()}"
+            )
         
     def performBackgroundTasks(self):
-        """Perform background tasks:
-            * save acquired data to binary file,
-            * adjust voltage of generator
+        """Perform background tasks, see `AcquisitionSession.processFrames`.
         """
-        if self.deviceManager != None:
-            data_list=[]
-            while not self.deviceManager.data_queue.empty():
-                data_list.append(
-                    self.deviceManager.data_queue.get()
-                )
-
-                if len(data_list) >= 8:
-                    break
-
-            self.poolExecutor.submit(list_to_binary_file,
-                                    self.tempDataFile.name,
-                                    data_list)
-            
-            # update signal register
-            self.deviceManager.amplitudeRegulator \
-                .signalRegister.extend(data_list)
-            
-            # if generator is on then update amplitude
-            if self.deviceManager.gen__getattr__('state'):
-                self.deviceManager.updateAmplitude()
+        self.session.processFrames()
+
+    def setStorageMode(self, mode : str):
+        self.session.setStorageMode(mode)
+
+    def setControlStrategy(self, strategy : str):
+        self.session.setControlStrategy(strategy)
+
+    def setRegulatorDecimation(self, enabled : bool):
+        self.session.setRegulatorDecimation(enabled)
+
+    def setStreaming(self, enabled : bool):
+        try:
+            self.session.setStreaming(DEFAULT_ADDRESS if enabled else None)
+        except OSError as e:
+            self.showErrorMessageBox(e, f'Streaming server could not listen on {DEFAULT_ADDRESS}.')
 
     def saveFile(self):
         """Perform neccesary checks and save acquired data to archive.
         """
-        if not self.tempDataAcquired:
-            self.showErrorMessageBox(
-                'No data to save!', 'Try performing acquisitioin and saving.'
-            )
-            return
-        
-        if self.deviceManager.pause_event.is_set():
-            self.showErrorMessageBox(
-                'Acquisition running!', 'Try stoping acquisitioin and saving.'
-            )
-            return
-        
-        if not self.deviceManager.data_queue.empty():
-            self.showErrorMessageBox(
-                'Data in queue!', ('Try waiting a while.'
-                                   ' Data in queue waiting to be processed:'
-                                   f' {self.deviceManager.data_queue.qsize()}.')
-            )
+        blocker = self.session.saveBlocker()
+        if blocker != None:
+            self.showErrorMessageBox(*blocker)
             return
-        
+
         path = super().saveFile()
 
         if path:
-            metadata = {}
-            if self.deviceManager != None:
-                metadata['scope'] = {
-                    'scope_name'    : self.deviceManager.osc__getattr__('instrument_name'),
-                    'sample_rate'   : self.deviceManager.osc__getattr__('analog_sample_rate'),
-                    'record_length' : self.deviceManager.osc__getattr__('record_length'),
-                }
-                metadata['generator'] = {
-                    'generator_name': self.deviceManager.gen__getattr__('instrument_name'),
-                    'frequency'     : self.deviceManager.gen__getattr__('frequency'),
-                    'amplitude'     : self.deviceManager.gen__getattr__('amplitude')
-                }
-
-            # write_archive process wrapper; keeps tempDataFile from beeing deleted
-            # before creating an archive
-            self.poolExecutor.submit(write_archive_xy, metadata,
-                                     self.deviceManager.osc_call_method('fetch_x_data'),
-                                     self.tempDataFile.name, path)
-            self.tempDataFile = NamedTemporaryFile(dir=self.tempDataDir.name, delete=False)
-            self.tempDataAcquired = False
+            self.session.save(path)
+
+    def updateArchiveProgress(self):
+        """Show progress and ETA of archive being written.
+        """
+        if self.session.archiveFuture == None:
+            return
+
+        if self.session.archiveFuture.done():
+            self.archiveProgressBar.setVisible(False)
+            error = self.session.archiveFuture.exception()
+            self.session.archiveFuture, self.session.archiveProgress = None, None
+            if error is not None:
+                self.showErrorMessageBox(error, 'Archive was not written, journal is kept.')
+            return
+
+        if (progress := self.session.archiveStatus()) != None:
+            fraction, eta = progress
+
+            self.archiveProgressBar.setVisible(True)
+            self.archiveProgressBar.setValue(int(100 * fraction))
+            self.archiveProgressBar.setFormat(f'Saving %p%  ETA {eta:.0f} s')
 
     def close(self):
         """Application window will close, than all the devices and processes.
         """
         super().close()
-        self.poolExecutor.shutdown(wait=True)
-
-        if self.deviceManager != None:
-            self.deviceManager.stop()
\ No newline at end of file
+        self.deviceDiscovery.stop()
+        self.recoveryExecutor.shutdown(wait=True)
+        self.session.close()
@@ -0,0 +1,89 @@
+from threading import Lock
+
+# load shedding levels, each level includes the previous ones
+SHED_NONE       = 0
+SHED_PREVIEWS   = 1     # drop preview/stream frames
+SHED_DECIMATE   = 2     # feed only every other frame to the regulator
+SHED_THROTTLE   = 3     # slow down acquisition
+SHED_LEVELS = ('none', 'drop previews', 'decimate regulator input', 'throttle acquisition')
+
+# accounted categories
+CATEGORIES = ('queue', 'register', 'preview', 'writes')
+
+class MemoryBudget:
+    def __init__(self, cap_bytes : int = 1 << 30, thresholds : tuple = (0.6, 0.75, 0.9),
+                 hysteresis : float = 0.05) -> None:
+        """Accounts bytes held by data queue, regulator register, preview buffers
+        and in-flight writes and decides how much load has to be shed to stay
+        below cap. Levels rise when usage exceeds thresholds[level - 1] * cap and
+        fall when usage drops hysteresis below it. Thread safe, writes are
+        released from executor callbacks.
+
+        Args:
+            cap_bytes (int, optional): memory cap. Defaults to 1 GiB.
+            thresholds (tuple, optional): fractions of cap at which SHED_PREVIEWS,
+                SHED_DECIMATE and SHED_THROTTLE start. Defaults to (0.6, 0.75, 0.9).
+            hysteresis (float, optional): fraction of cap. Defaults to 0.05.
+        """
+        self.cap_bytes  = cap_bytes
+        self.thresholds = thresholds
+        self.hysteresis = hysteresis
+
+        self._lock  = Lock()
+        self._usage = dict.fromkeys(CATEGORIES, 0)
+        self._level = SHED_NONE
+
+    def set(self, category : str, nbytes : int) -> None:
+        with self._lock:
+            self._usage[category] = nbytes
+
+    def add(self, category : str, nbytes : int) -> None:
+        with self._lock:
+            self._usage[category] += nbytes
+
+    def release(self, category : str, nbytes : int) -> None:
+        with self._lock:
+            self._usage[category] = max(0, self._usage[category] - nbytes)
+
+    @property
+    def total(self) -> int:
+        with self._lock:
+            return sum(self._usage.values())
+
+    @property
+    def usage(self) -> dict:
+        with self._lock:
+            return dict(self._usage)
+
+    @property
+    def level(self) -> int:
+        return self._level
+
+    def update(self) -> int:
+        """Recalculate shedding level from current usage.
+
+        Returns:
+            int: shedding level (SHED_*)
+        """
+        fraction = self.total / self.cap_bytes
+
+        level = self._level
+        while level < len(self.thresholds) and fraction > self.thresholds[level]:
+            level += 1
+        while level > SHED_NONE and fraction < self.thresholds[level - 1] - self.hysteresis:
+            level -= 1
+
+        self._level = level
+        return level
+
+    def report(self) -> str:
+        """Usage summary for status bar.
+        """
+        usage = self.usage
+        details = ', '.join(f'{name} {nbytes / 2**20:.0f}' for name, nbytes in usage.items() if nbytes)
+        text = f'Memory: {sum(usage.values()) / 2**20:.0f}/{self.cap_bytes / 2**20:.0f} MB'
+        if details:
+            text += f' ({details})'
+        if self._level != SHED_NONE:
+            text += f' - {SHED_LEVELS[self._level]}'
+        return text
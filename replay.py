@@ -0,0 +1,304 @@
+import json
+import os
+import shutil
+import zipfile
+from queue import Queue
+from tempfile import NamedTemporaryFile
+from time import perf_counter, sleep
+
+from numpy import memmap, float64, arange, frombuffer, fromfile, isfinite
+from numpy.typing import NDArray
+
+from generator_safety import AmplitudeRegulator, Decimator, CONTROL_STRATEGIES, clip
+from workers import Frame
+from journal import FRAME_INFO
+from telemetry import read_telemetry
+
+# frames per second of archives without frame times nor telemetry
+DEFAULT_FRAME_RATE = 10.
+
+
+def open_archive_frames(archive_path : str) -> tuple:
+    """Opens frames of archive created by `save_file.write_archive_xy` as read
+    only memory map. Archive is compressed, so ydata.bin is first extracted
+    to a temporary file (streamed, not loaded into memory). Directory with
+    already extracted metadata.txt and ydata.bin is mapped directly.
+
+    Args:
+        archive_path (str): path to zip archive or extracted archive directory
+
+    Returns:
+        tuple: (metadata dict, frames memmap of shape (N, record_length))
+    """
+    if os.path.isdir(archive_path):
+        with open(os.path.join(archive_path, 'metadata.txt'), 'r') as file:
+            metadata = json.load(file)
+        ydata_path = os.path.join(archive_path, 'ydata.bin')
+    else:
+        with zipfile.ZipFile(archive_path, 'r') as archive_file:
+            names = archive_file.namelist()
+            metadata_name = next(n for n in names if n.endswith('metadata.txt'))
+            ydata_name    = next(n for n in names if n.endswith('ydata.bin'))
+
+            metadata = json.loads(archive_file.read(metadata_name))
+
+            # extracted file is unlinked once memmap is closed
+            with archive_file.open(ydata_name) as source, \
+                 NamedTemporaryFile(suffix='.bin', delete=False) as dest:
+                shutil.copyfileobj(source, dest, length=1 << 24)
+                ydata_path = dest.name
+
+    record_length = metadata['scope']['record_length']
+    frames = memmap(ydata_path, dtype=float64, mode='r').reshape((-1, record_length))
+
+    if not os.path.isdir(archive_path):
+        # file stays accessible through the mapping on posix systems
+        os.remove(ydata_path)
+
+    return metadata, frames
+
+def open_archive_frame_info(archive_path : str):
+    """Reads frames.bin side array (journal.FRAME_INFO) of archive or extracted
+    archive directory.
+
+    Returns:
+        NDArray | None: frame info, None for archives saved without it
+    """
+    if os.path.isdir(archive_path):
+        info_path = os.path.join(archive_path, 'frames.bin')
+        return fromfile(info_path, dtype=FRAME_INFO) if os.path.exists(info_path) else None
+
+    with zipfile.ZipFile(archive_path, 'r') as archive_file:
+        info_name = next((n for n in archive_file.namelist() if n.endswith('/frames.bin')), None)
+        if info_name is None:
+            return None
+        return frombuffer(archive_file.read(info_name), dtype=FRAME_INFO)
+
+def estimate_frame_rate(archive_path : str, metadata : dict, n_frames : int) -> float | None:
+    """Frame rate of archive saved without frame times (frames.bin): saved frames
+    over session duration spanned by telemetry timestamps.
+
+    Returns:
+        float | None: frames per second, None if archive has no telemetry
+    """
+    schema = metadata.get('telemetry')
+    if schema is None or n_frames < 2:
+        return None
+
+    if os.path.isdir(archive_path):
+        path = os.path.join(archive_path, 'telemetry', 'timestamp.bin')
+        if not os.path.exists(path):
+            return None
+        timestamps = fromfile(path, dtype=schema['columns']['timestamp'])
+    else:
+        timestamps = read_telemetry(archive_path, ['timestamp'])['timestamp']
+
+    timestamps = timestamps[isfinite(timestamps)]
+    if len(timestamps) < 2 or timestamps.max() <= timestamps.min():
+        return None
+    return (n_frames - 1) / float(timestamps.max() - timestamps.min())
+
+class ReplayGenerator:
+    """Stand-in for instruments.Generator, keeps amplitude and frequency
+    set by the regulator.
+    """
+    def __init__(self, frequency : float, amplitude : float, state : bool = True) -> None:
+        self.frequency  = frequency
+        self.amplitude  = amplitude
+        self.state      = state
+
+class ReplayEngine:
+    def __init__(self, archive_path : str, regulator : AmplitudeRegulator = None,
+                 initial_amplitude : float = 0.020, frame_rate : float = None,
+                 update_interval : float = 1., batch_size : int = 8,
+                 asynchronous : bool = False) -> None:
+        """Replays archived session through the same data_queue -> signalRegister ->
+        AmplitudeRegulator path as MainWindow.performBackgroundTasks. Replay runs on
+        a simulated clock, so the amplitude trajectory doesn't depend on replay speed.
+        Frames are replayed at their recorded acquisition times (frames.bin), archives
+        without them are replayed at frame_rate. Regulator cadence relative to frames
+        (and so the trajectory) depends on it, if it isn't given it's estimated from
+        session telemetry, DEFAULT_FRAME_RATE is used (with warning) as the last resort.
+
+        Args:
+            archive_path (str): path to archive or extracted archive directory
+            regulator (AmplitudeRegulator, optional): regulator under test. Defaults to AmplitudeRegulator(8).
+            initial_amplitude (float, optional): generator amplitude at the start. Defaults to 0.020.
+            frame_rate (float, optional): frames per second of the session if archive has
+                no frame times. Defaults to None (estimated, see `estimate_frame_rate`).
+            update_interval (float, optional): interval of regulator updates (updateTimer) in seconds. Defaults to 1.
+            batch_size (int, optional): max frames taken from queue per update. Defaults to 8.
+            asynchronous (bool, optional): use `updateAmplitudeAsync` like DeviceManagerProcess,
+                spectrum is applied one update later. Defaults to False.
+        """
+        self.metadata, self.frames = open_archive_frames(archive_path)
+        self.frame_info = open_archive_frame_info(archive_path)
+
+        self.regulator          = AmplitudeRegulator(8) if regulator is None else regulator
+        self.generator          = ReplayGenerator(
+            self.metadata['generator']['frequency'],
+            clip(initial_amplitude, 0.020, 2.0),
+        )
+        self.sample_rate        = self.metadata['scope']['sample_rate']
+        self.frame_rate         = frame_rate
+
+        if self.frame_rate is None and not self.timestamped:
+            self.frame_rate = estimate_frame_rate(archive_path, self.metadata, len(self.frames))
+            if self.frame_rate is None:
+                self.frame_rate = DEFAULT_FRAME_RATE
+                print(f'Warning: {archive_path} has neither frame times nor telemetry, '
+                      f'frames are replayed at {self.frame_rate:g} fps (set frame rate explicitly).')
+            else:
+                print(f'Frame rate estimated from session telemetry: {self.frame_rate:.2f} fps')
+        elif self.frame_rate is None:
+            self.frame_rate = DEFAULT_FRAME_RATE
+        self.update_interval    = update_interval
+        self.batch_size         = batch_size
+        self.asynchronous       = asynchronous
+
+        self.data_queue         = Queue()
+
+    @property
+    def timestamped(self) -> bool:
+        """True if archive has acquisition times of all frames.
+        """
+        return (self.frame_info is not None and len(self.frame_info) == len(self.frames)
+                and bool(isfinite(self.frame_info['timestamp']).all()))
+
+    @property
+    def duration(self) -> float:
+        """Duration of replayed session in seconds (simulated time).
+        """
+        if self.timestamped and len(self.frames):
+            return float(self.frame_times()[-1]) + 1 / self.frame_rate
+        return len(self.frames) / self.frame_rate
+
+    def frame_times(self) -> NDArray:
+        """Acquisition times of frames in seconds from the session start, recorded
+        ones if archive has them, frame_rate based otherwise.
+        """
+        if self.timestamped:
+            timestamps = self.frame_info['timestamp']
+            return timestamps - timestamps[0]
+        return arange(len(self.frames)) / self.frame_rate
+
+    def run(self, speed : float = None) -> dict:
+        """Run replay.
+
+        Args:
+            speed (float, optional): replay speed relative to real-time, None runs
+                as fast as possible. Defaults to None.
+
+        Returns:
+            dict: {'time': [...], 'amplitude': [...], 'frames': int,
+                   'wall_time': float, 'realtime_factor': float}
+        """
+        times, amplitudes = [0.], [self.generator.amplitude]
+
+        frame_times = self.frame_times()
+        n_frames    = len(self.frames)
+        next_frame  = 0
+        tick        = 0
+
+        t_start = perf_counter()
+        while next_frame < n_frames or not self.data_queue.empty():
+            tick += 1
+            sim_time = tick * self.update_interval
+
+            if speed is not None:
+                delay = sim_time / speed - (perf_counter() - t_start)
+                if delay > 0:
+                    sleep(delay)
+
+            # frames acquired since last update
+            while next_frame < n_frames and frame_times[next_frame] < sim_time:
+                self.data_queue.put(Frame(self.frames[next_frame], False, False, next_frame))
+                next_frame += 1
+
+            self.update()
+
+            times.append(sim_time)
+            amplitudes.append(self.generator.amplitude)
+
+        wall_time = perf_counter() - t_start
+
+        return {
+            'time'              : times,
+            'amplitude'         : amplitudes,
+            'frames'            : n_frames,
+            'wall_time'         : wall_time,
+            'realtime_factor'   : times[-1] / wall_time if wall_time > 0 else float('inf'),
+        }
+
+    def update(self) -> None:
+        """Single updateTimer tick of MainWindow.performBackgroundTasks.
+        """
+        frame_list=[]
+        while not self.data_queue.empty():
+            frame_list.append(self.data_queue.get())
+
+            if len(frame_list) >= self.batch_size:
+                break
+
+        self.regulator.addSignals(
+            [frame.y for frame in frame_list],
+            self.sample_rate,
+            self.generator.frequency,
+        )
+
+        if self.generator.state and self.asynchronous:
+            v = self.regulator.updateAmplitudeAsync(
+                self.generator.amplitude,
+                self.generator.frequency,
+                self.sample_rate,
+            )
+            # spectrum is ready by the next update, regardless of replay speed
+            self.regulator.waitSpectrum()
+            if v is not None:
+                self.generator.amplitude = v
+        elif self.generator.state:
+            self.generator.amplitude = self.regulator.updateAmplitude(
+                self.generator.amplitude,
+                self.generator.frequency,
+                self.sample_rate,
+            )
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Replay archived session through amplitude regulator.')
+    parser.add_argument('archive', help='archive (.zip) or extracted archive directory')
+    parser.add_argument('--speed', type=float, default=None,
+                        help='replay speed relative to real-time, as fast as possible if omitted')
+    parser.add_argument('--frame-rate', type=float, default=None,
+                        help='frames per second of recorded session without frame times, '
+                             'estimated from telemetry if omitted')
+    parser.add_argument('--threshold', type=float, default=100,
+                        help='AmplitudeRegulator threshold')
+    parser.add_argument('--strategy', choices=CONTROL_STRATEGIES, default='bisection',
+                        help='amplitude control strategy')
+    parser.add_argument('--max-slew', type=float, default=0.1,
+                        help='max voltage change per update in V')
+    parser.add_argument('--window', type=int, default=8,
+                        help='AmplitudeRegulator window length')
+    parser.add_argument('--decimate', action='store_true',
+                        help='decimate regulator input')
+    parser.add_argument('--initial-amplitude', type=float, default=0.020)
+    parser.add_argument('--async', dest='asynchronous', action='store_true',
+                        help='apply spectra one update later, as the device process does')
+    args = parser.parse_args()
+
+    engine = ReplayEngine(args.archive,
+                          AmplitudeRegulator(args.window, threshold=args.threshold,
+                                             strategy=CONTROL_STRATEGIES[args.strategy](max_slew=args.max_slew),
+                                             decimator=Decimator() if args.decimate else None),
+                          initial_amplitude=args.initial_amplitude,
+                          frame_rate=args.frame_rate,
+                          asynchronous=args.asynchronous)
+    result = engine.run(args.speed)
+
+    print('time,amplitude')
+    for t, v in zip(result['time'], result['amplitude']):
+        print(f'{t:.3f},{v:.3f}')
+    print(f"Replayed {result['frames']} frames in {result['wall_time']:.3f} s "
+          f"({result['realtime_factor']:.1f}x real-time)")
@@ -2,10 +2,17 @@ import json
 from multiprocessing import Queue
 from tempfile import NamedTemporaryFile
 import zipfile
+import zlib
 import os
+from collections import deque
+from io import BytesIO
 
 from numpy.typing import NDArray
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
 
+# max bytes of y data read ahead (and compressed) by write_deflated_parallel
+READ_AHEAD_BYTES = 1 << 27
 
 
 def write_archive(metadata : dict, source_data_name : str, dest_archive : str):
@@ -30,14 +37,24 @@ def write_archive(metadata : dict, source_data_name : str, dest_archive : str):
 def write_archive_xy(metadata           : dict,
                      x_data_array       : NDArray,
                      y_data_file_path   : str,
-                     dest_archive       : str):
+                     dest_archive       : str,
+                     compresslevel      : int = 9,
+                     workers            : int = None,
+                     progress           : Callable = None,
+                     extra_files        : dict = None):
     """Writes metadata x and y values of the scope into a compressed zip archive.
+    y data is compressed in parallel, see `write_deflated_parallel`.
 
     Args:
         metadata (dict): metadata dictionary with generator/osciloscope info
         x_data_array (ndarray): array of x values of osciloscope (time)
         y_data_file_path (str): path to binary file with y data
         dest_archive (str): path to destination archive
+        compresslevel (int, optional): deflate level. Defaults to 9.
+        workers (int, optional): number of compression threads. Defaults to None (all cores).
+        progress (Callable, optional): called with (bytes done, bytes total). Defaults to None.
+        extra_files (dict, optional): {member name: path} of additional files
+            (e.g. telemetry columns) stored next to ydata.bin. Defaults to None.
     """
     metadata['description'] = ("Data recorded from a data gathering session, "
     "can be found inside data.bin file. It is a binary file that consists of "
@@ -66,14 +83,150 @@ def write_archive_xy(metadata           : dict,
         )
 
         # Write y data to archive from y_data_file_path
-        archive_file.write(
+        write_deflated_parallel(
+            archive_file,
             y_data_file_path,
-            os.path.join(directory, 'ydata.bin')
+            os.path.join(directory, 'ydata.bin'),
+            compresslevel=compresslevel,
+            workers=workers,
+            progress=progress,
         )
 
+        for arcname, path in (extra_files or {}).items():
+            archive_file.write(path, os.path.join(directory, arcname))
+
     print('Data Saved in:', dest_archive)
     os.remove(y_data_file_path)
 
+class _Precompressed:
+    """Stand-in for zlib compressor of zipfile member opened for writing.
+    Returns data compressed beforehand instead of compressing what is written.
+    """
+    def __init__(self) -> None:
+        self.next = b''
+
+    def compress(self, data) -> bytes:
+        compressed, self.next = self.next, b''
+        return compressed
+
+    def flush(self) -> bytes:
+        return b''
+
+# result of `precompressed_members_supported` check, None until checked
+_PRECOMPRESSED_SUPPORTED = None
+
+def precompressed_members_supported() -> bool:
+    """True if zipfile member opened for writing accepts `_Precompressed` in place
+    of its compressor. That's an implementation detail of CPython's zipfile
+    (`_ZipWriteFile._compressor`), so it's checked once by round-trip of
+    a small archive in memory.
+    """
+    global _PRECOMPRESSED_SUPPORTED
+    if _PRECOMPRESSED_SUPPORTED is None:
+        data   = bytes(range(256)) * 64
+        buffer = BytesIO()
+        try:
+            with zipfile.ZipFile(buffer, 'w') as archive_file:
+                zinfo = zipfile.ZipInfo('check')
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                with archive_file.open(zinfo, 'w') as member:
+                    if not hasattr(member, '_compressor'):
+                        raise AttributeError('_compressor')
+                    compressor = member._compressor = _Precompressed()
+                    for chunk, last in ((data[:8192], False), (data[8192:], True)):
+                        compressor.next = _deflate_chunk(chunk, 6, last)
+                        member.write(chunk)
+            with zipfile.ZipFile(buffer, 'r') as archive_file:
+                _PRECOMPRESSED_SUPPORTED = (archive_file.testzip() is None
+                                            and archive_file.read('check') == data)
+        except Exception:
+            _PRECOMPRESSED_SUPPORTED = False
+
+        if not _PRECOMPRESSED_SUPPORTED:
+            print('Parallel compression not supported by this zipfile, archives are compressed on a single core.')
+    return _PRECOMPRESSED_SUPPORTED
+
+def _deflate_chunk(data : bytes, level : int, last : bool) -> bytes:
+    """Raw deflate of chunk. Chunks other than the last one end with sync flush
+    (byte aligned, not final block), so compressed chunks can be concatenated
+    into a single deflate stream.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+def write_deflated_parallel(archive_file    : zipfile.ZipFile,
+                            source_path     : str,
+                            arcname         : str,
+                            compresslevel   : int = 9,
+                            workers         : int = None,
+                            chunk_size      : int = 1 << 24,
+                            progress        : Callable = None,
+                            read_ahead      : int = READ_AHEAD_BYTES):
+    """Writes file into archive as a regular deflated member, compressing
+    chunk_size chunks in parallel threads (zlib releases the GIL). At most
+    read_ahead bytes are read ahead, chunks are made smaller (down to 1 MiB)
+    if that's needed to keep every worker busy. Chunks are
+    concatenated into one deflate stream, like pigz does, so the archive can be
+    read by any zip tool. Dictionary is reset at chunk boundaries, which costs
+    a negligible amount of compression ratio. Falls back to `ZipFile.write`
+    (single thread) if zipfile doesn't support it, see
+    `precompressed_members_supported`.
+
+    Args:
+        archive_file (zipfile.ZipFile): archive opened for writing
+        source_path (str): path of file to write
+        arcname (str): name of member in archive
+        compresslevel (int, optional): deflate level. Defaults to 9.
+        workers (int, optional): number of compression threads. Defaults to None (all cores).
+        chunk_size (int, optional): size of chunk compressed by a single thread. Defaults to 16 MiB.
+        progress (Callable, optional): called with (bytes done, bytes total). Defaults to None.
+        read_ahead (int, optional): max bytes read ahead. Defaults to READ_AHEAD_BYTES (128 MiB).
+    """
+    workers = workers or os.cpu_count() or 1
+    total   = os.path.getsize(source_path)
+
+    # 2 chunks per worker, as many as fit into read_ahead
+    chunk_size = max(min(chunk_size, read_ahead // (2*workers)), 1 << 20)
+    max_chunks = max(1, min(2*workers, read_ahead // chunk_size))
+
+    if not precompressed_members_supported():
+        archive_file.write(source_path, arcname, zipfile.ZIP_DEFLATED, compresslevel)
+        if progress is not None:
+            progress(total, total)
+        return
+
+    zinfo = zipfile.ZipInfo.from_file(source_path, arcname)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+
+    with open(source_path, 'rb') as source, \
+         archive_file.open(zinfo, 'w', force_zip64=total > zipfile.ZIP64_LIMIT // 2) as member, \
+         ThreadPoolExecutor(max_workers=workers) as executor:
+        # zipfile computes crc and sizes from written data, compressed
+        # data comes from the stand-in compressor
+        compressor = member._compressor = _Precompressed()
+
+        pending = []
+        done    = 0
+        offset  = 0
+        while offset < total or pending:
+            while offset < total and len(pending) < max_chunks:
+                data = source.read(chunk_size)
+                offset += len(data)
+                pending.append((data, executor.submit(_deflate_chunk, data, compresslevel, offset >= total)))
+
+            data, future = pending.pop(0)
+            compressor.next = future.result()
+            member.write(data)
+
+            done += len(data)
+            if progress is not None:
+                progress(done, total)
+
+        if total == 0:
+            # empty deflate stream
+            compressor.next = _deflate_chunk(b'', compresslevel, True)
+            member.write(b'')
+
 def append_binary_file(dest_file : str, data : NDArray):
         # write y-vals of the waveform into file
         with open(dest_file, 'ab') as file:
@@ -96,3 +249,83 @@ def list_to_binary_file(dest_file : str, data_list : list):
         for array in data_list:
             file.write(array.tobytes())
 
+STORAGE_MODES = ('all', 'flagged', 'decimate')
+
+class StoragePolicy:
+    def __init__(self, mode : str = 'all', context : int = 2, decimation : int = 10) -> None:
+        """Decides which frames are written to disk. Modes:
+            * 'all'      - keep every frame,
+            * 'flagged'  - keep flagged frames and `context` frames before and after them,
+            * 'decimate' - keep flagged frames and every `decimation`-th quiet frame.
+        In 'flagged' mode frames are released with up to `context` frames delay,
+        because frames preceding a flagged one have to be held back.
+
+        Args:
+            mode (str, optional): one of STORAGE_MODES. Defaults to 'all'.
+            context (int, optional): number of context frames. Defaults to 2.
+            decimation (int, optional): quiet frames decimation factor. Defaults to 10.
+        """
+        self.context    = context
+        self.decimation = decimation
+        self._pending   = deque()
+        self._post      = 0
+        self._quiet     = 0
+        self.mode       = mode
+
+    @property
+    def mode(self) -> str:
+        return self._mode
+
+    @mode.setter
+    def mode(self, value : str) -> None:
+        if value not in STORAGE_MODES:
+            raise ValueError(f"Unknown storage mode '{value}', expected one of {STORAGE_MODES}.")
+        self._mode = value
+
+    def __call__(self, frame, flagged : bool) -> list:
+        """Feed new frame to policy.
+
+        Args:
+            frame (Any): frame object
+            flagged (bool): classifier decision
+
+        Returns:
+            list: released (frame, store) pairs in acquisition order
+        """
+        released = []
+
+        # frames held back by previous mode are released first
+        if self._mode != 'flagged' and self._pending:
+            released.extend(self.flush())
+
+        match self._mode:
+            case 'all':
+                released.append((frame, True))
+            case 'decimate':
+                if flagged:
+                    released.append((frame, True))
+                else:
+                    released.append((frame, self._quiet % self.decimation == 0))
+                    self._quiet += 1
+            case 'flagged':
+                if flagged:
+                    released.extend((f, True) for f in self._pending)
+                    self._pending.clear()
+                    released.append((frame, True))
+                    self._post = self.context
+                elif self._post > 0:
+                    released.append((frame, True))
+                    self._post -= 1
+                else:
+                    self._pending.append(frame)
+                    if len(self._pending) > self.context:
+                        released.append((self._pending.popleft(), False))
+
+        return released
+
+    def flush(self) -> list:
+        """Release all held back frames as not stored.
+        """
+        released = [(f, False) for f in self._pending]
+        self._pending.clear()
+        return released
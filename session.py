@@ -0,0 +1,523 @@
+from workers import DeviceSupervisor, STATISTICS
+from save_file import READ_AHEAD_BYTES
+from journal import (new_journal_path, append_journal, journal_to_archive,
+                     write_session_metadata, remove_journal)
+from generator_safety import CONTROL_STRATEGIES, FixedStepStrategy, Decimator
+from memory_budget import MemoryBudget, SHED_PREVIEWS, SHED_DECIMATE, SHED_THROTTLE
+from telemetry import TelemetryLog, telemetry_directory
+from streaming import StreamServer
+
+import os
+from math import isfinite
+
+from collections import deque
+from itertools import groupby
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from time import monotonic, time
+
+def finite_or_none(value : float) -> float | None:
+    """nan (no measurement yet) isn't valid json.
+    """
+    return value if isfinite(value) else None
+
+class TriggerRateMeter:
+    def __init__(self, window : float = 10.) -> None:
+        """Effective trigger rate and dead-time fraction of acquisition over the
+        last `window` seconds, from frame acquisition numbers and timestamps.
+        Frames arriving between acquisition numbers were missed by the host,
+        triggers during waveform transfers are missed by the scope (dead time).
+
+        Args:
+            window (float, optional): averaging window in seconds. Defaults to 10.
+        """
+        self.window     = window
+        self._frames    = deque()   # (timestamp, acquisition, transfer time)
+
+    def update(self, frames : list) -> None:
+        for frame in frames:
+            if frame.sequence >= 0 and frame.timestamp == frame.timestamp:
+                self._frames.append((frame.timestamp, frame.sequence, frame.transfer_time))
+
+        if self._frames:
+            latest = max(timestamp for timestamp, _, _ in self._frames)
+            while self._frames and self._frames[0][0] < latest - self.window:
+                self._frames.popleft()
+
+    def _span(self) -> tuple:
+        if len(self._frames) < 2:
+            return None
+        first = min(self._frames)
+        last  = max(self._frames)
+        return first, last, last[0] - first[0]
+
+    @property
+    def rate(self) -> float:
+        """Frames per second, nan until two frames arrived.
+        """
+        span = self._span()
+        if span is None or span[2] <= 0:
+            return float('nan')
+        first, last, duration = span
+        return (last[1] - first[1]) / duration
+
+    @property
+    def deadTime(self) -> float:
+        """Fraction of time spent on waveform transfers.
+        """
+        span = self._span()
+        if span is None or span[2] <= 0:
+            return float('nan')
+        first, _, duration = span
+        transfer = sum(t for timestamp, _, t in self._frames if timestamp > first[0] and t == t)
+        return min(1., transfer / duration)
+
+    def reset(self) -> None:
+        self._frames.clear()
+
+class AcquisitionSession:
+    def __init__(self, storage_mode : str = 'all', control_strategy : str = 'bisection',
+                 regulator_decimation : bool = False, memory_cap : int = 1 << 30,
+                 throttle_delay : float = 0.1, batch_size : int = 8,
+                 archive_workers : int = None, stream_address : str = None) -> None:
+        """Acquisition pipeline without any GUI: device process supervision,
+        crash-safe journal, telemetry, memory budget, amplitude regulation and
+        archive writing. Driven periodically (`supervise`, `processFrames`) by
+        MainWindow's updateTimer or headless event loop.
+
+        Args:
+            storage_mode (str, optional): storage policy, see save_file.STORAGE_MODES. Defaults to 'all'.
+            control_strategy (str, optional): amplitude control strategy. Defaults to 'bisection'.
+            regulator_decimation (bool, optional): decimate regulator input. Defaults to False.
+            memory_cap (int, optional): memory budget cap in bytes. Defaults to 1 GiB.
+            throttle_delay (float, optional): min delay after each frame when throttled. Defaults to 0.1.
+            batch_size (int, optional): max frames processed per call of processFrames. Defaults to 8.
+            archive_workers (int, optional): compression threads. Defaults to None (all cores).
+            stream_address (str, optional): address of streaming server, see
+                streaming.StreamServer. Defaults to None (no streaming).
+        """
+        # acquired frames are appended to crash-safe journal
+        self.journalPath        = new_journal_path()
+        self.journalSequence    = 0
+        self.journalWrites      = []    # futures of pending journal appends
+        self.tempDataAcquired   = False
+        self.telemetry          = None  # TelemetryLog of the session, next to journal
+        self.frameIndex         = 0     # frames processed in session
+        self.rateMeter          = TriggerRateMeter()
+        self.storageMode        = storage_mode
+        self.controlStrategy    = control_strategy
+        self.regulatorDecimation= regulator_decimation
+        self.sampleRate         = None  # analog sample rate, updated on acquisition start
+        self.preamble           = None  # scope waveform scaling, updated on acquisition start
+        self.batchSize          = batch_size
+
+        self.deviceManager      = None
+        self.deviceSupervisor   = None
+
+        self.poolExecutor = ProcessPoolExecutor(max_workers=1)
+
+        # archives are written in a thread of this process (progress reporting),
+        # compression runs on archiveWorkers threads, separate from journal writer
+        self.archiveExecutor    = ThreadPoolExecutor(max_workers=1)
+        self.archiveWorkers     = archive_workers or os.cpu_count()
+        self.archiveFuture      = None
+        self.archiveProgress    = None  # (bytes done, bytes total, start time)
+
+        # memory held by queue, register and in-flight writes is kept under cap
+        self.memoryBudget       = MemoryBudget(cap_bytes=memory_cap)
+        self.frameBytes         = 0     # size of the last acquired frame
+        self.throttleDelay      = throttle_delay
+        self.tickInterval       = 0.    # time between the last two calls of processFrames
+        self._lastTick          = None
+
+        # live frames for analysis clients, dropped first under memory pressure
+        self.streamServer       = None
+        if stream_address != None:
+            self.setStreaming(stream_address)
+
+    def connect(self, deviceOsc, deviceGen) -> None:
+        """Start device process for oscilloscope and generator and a new journal.
+        """
+        self.deviceSupervisor = DeviceSupervisor(deviceOsc, deviceGen,
+                                                 storage_mode=self.storageMode)
+        self.deviceManager = self.deviceSupervisor.manager
+        self.setControlStrategy(self.controlStrategy)
+        self.setRegulatorDecimation(self.regulatorDecimation)
+        self.sampleRate = self.deviceManager.osc__getattr__('analog_sample_rate')
+        self.startJournal()
+        self.updatePreamble()
+
+    @property
+    def devicesReady(self) -> bool:
+        """True if device process is running, device calls fail while it's dead
+        or being restarted.
+        """
+        return (self.deviceManager != None and self.deviceManager.is_alive()
+                and not (self.deviceSupervisor != None and self.deviceSupervisor.restart_pending))
+
+    @property
+    def acquiring(self) -> bool:
+        return self.deviceManager != None and self.deviceManager.pause_event.is_set()
+
+    def setAcquisition(self, state : bool) -> None:
+        """Start or stop acquisition.
+        """
+        if self.deviceManager != None and state != self.acquiring:
+            # Update sample rate
+            self.sampleRate = self.deviceManager.osc__getattr__('analog_sample_rate')
+            if state:
+                self.updatePreamble()
+                self.rateMeter.reset()
+            self.deviceManager.togglePause()
+
+    def updatePreamble(self) -> None:
+        """Fetch scope waveform scaling, streamed frames are quantized with it.
+        """
+        self.preamble = self.deviceManager.osc_call_method('fetch_preamble')
+        if self.streamServer != None:
+            self.streamServer.setMetadata(self.collectMetadata(), self.preamble)
+
+    def setStreaming(self, address : str | None) -> None:
+        """Start streaming server on address, stop it if address is None.
+        """
+        if self.streamServer != None:
+            self.streamServer.stop()
+            self.streamServer = None
+            self.memoryBudget.set('preview', 0)
+
+        if address != None:
+            self.streamServer = StreamServer(address)
+            self.streamServer.start()
+            if self.deviceManager != None:
+                self.streamServer.setMetadata(self.collectMetadata(), self.preamble)
+
+    def supervise(self) -> None:
+        """Restart device process if it died.
+
+        Raises:
+            RuntimeError: device process can't be restarted anymore
+        """
+        if self.deviceSupervisor != None:
+            try:
+                self.deviceManager = self.deviceSupervisor.ensure_running()
+            except Exception:
+                self.deviceSupervisor = None
+                self.deviceManager = None
+                raise
+
+    def startJournal(self):
+        """Write metadata of the session next to the journal, so it can be
+        recovered into a complete archive.
+        """
+        metadata = self.collectMetadata()
+        x_data = self.deviceManager.osc_call_method('fetch_x_data')
+        if x_data is not None and len(x_data) > 1:
+            metadata['scope']['x_origin']    = float(x_data[0])
+            metadata['scope']['x_increment'] = float(x_data[1] - x_data[0])
+        write_session_metadata(self.journalPath, metadata)
+        self.telemetry = TelemetryLog(telemetry_directory(self.journalPath))
+
+    def collectMetadata(self) -> dict:
+        """Metadata of the session saved in archive.
+        """
+        metadata = {}
+        if self.deviceManager != None:
+            metadata['scope'] = {
+                'scope_name'    : self.deviceManager.osc__getattr__('instrument_name'),
+                'sample_rate'   : self.deviceManager.osc__getattr__('analog_sample_rate'),
+                'record_length' : self.deviceManager.osc__getattr__('record_length'),
+            }
+            if self.preamble != None:
+                # waveform scaling, lets converters re-quantize frames to int16
+                metadata['scope']['preamble'] = self.preamble
+            metadata['generator'] = {
+                'generator_name': self.deviceManager.gen__getattr__('instrument_name'),
+                'frequency'     : self.deviceManager.gen__getattr__('frequency'),
+                'amplitude'     : self.deviceManager.gen__getattr__('amplitude')
+            }
+            metadata['storage'] = {
+                'mode'          : self.storageMode,
+            }
+            # frame timestamps are time.monotonic(), clock pair maps them to epoch
+            metadata['clock'] = {
+                'time'          : time(),
+                'monotonic'     : monotonic(),
+            }
+        return metadata
+
+    def processFrames(self) -> list:
+        """Perform background tasks:
+            * save acquired data to binary file,
+            * adjust voltage of generator,
+            * log session telemetry
+
+        Returns:
+            list: processed frames
+        """
+        if not self.devicesReady:
+            # frames wait in data_queue until device process is restarted
+            return []
+
+        # drain rate of data_queue, see updateMemoryBudget
+        now = monotonic()
+        if self._lastTick != None:
+            self.tickInterval = now - self._lastTick
+        self._lastTick = now
+
+        frame_list=[]
+        while not self.deviceManager.data_queue.empty():
+            frame_list.append(
+                self.deviceManager.data_queue.get()
+            )
+
+            if len(frame_list) >= self.batchSize:
+                break
+
+        processed = list(frame_list)
+        if frame_list:
+            self.frameBytes = frame_list[-1].y.nbytes
+
+        self.rateMeter.update(frame_list)
+
+        # only frames selected by storage policy are written
+        data_list=[frame.y for frame in frame_list if frame.store]
+        if data_list:
+            write=self.poolExecutor.submit(append_journal,
+                                    self.journalPath,
+                                    data_list,
+                                    self.journalSequence,
+                                    [(frame.sequence, frame.timestamp, frame.trigger_time,
+                                      frame.transfer_time) for frame in frame_list if frame.store])
+            self.journalWrites.append(write)
+            self.journalSequence += len(data_list)
+            self.tempDataAcquired = True
+
+            # in-flight writes hold pickled copies of frames
+            write_bytes = sum(y.nbytes for y in data_list)
+            self.memoryBudget.add('writes', write_bytes)
+            write.add_done_callback(
+                lambda _, n=write_bytes: self.memoryBudget.release('writes', n)
+            )
+        self.journalWrites = [write for write in self.journalWrites if not write.done()]
+
+        level = self.updateMemoryBudget()
+
+        # update signal register, shed load under memory pressure
+        if level >= SHED_DECIMATE:
+            frame_list = frame_list[::2]
+        # frames acquired at an amplitude other than the register's replace it
+        frequency = self.deviceManager.gen__getattr__('frequency')
+        for amplitude, frames in groupby(frame_list, key=lambda frame: finite_or_none(frame.amplitude)):
+            self.deviceManager.amplitudeRegulator.addSignals(
+                [frame.y for frame in frames],
+                self.sampleRate,
+                frequency,
+                amplitude,
+            )
+
+        # if generator is on then update amplitude
+        if self.deviceManager.gen__getattr__('state'):
+            self.deviceManager.updateAmplitude()
+
+        # stream frames unless previews are shed
+        if self.streamServer != None and level < SHED_PREVIEWS:
+            self.streamServer.publish(processed)
+
+        self.logTelemetry(processed)
+
+        return processed
+
+    def logTelemetry(self, frames : list):
+        """Append telemetry row for each of frames processed in this tick. Timestamp,
+        amplitude, queue depth and classifier margin are taken from the frame,
+        regulator margin and peaks are the current regulator state.
+        """
+        if self.telemetry == None or not frames:
+            return
+
+        regulator   = self.deviceManager.amplitudeRegulator
+        now         = time()
+        # frame timestamps are monotonic, telemetry is in epoch time
+        offset      = now - monotonic()
+        # fetched only for frames acquired before generator amplitude was known
+        amplitude   = None
+        for frame in frames:
+            timestamp = frame.timestamp + offset if frame.timestamp == frame.timestamp else now
+            if frame.amplitude != frame.amplitude and amplitude is None:
+                amplitude = self.deviceManager.gen__getattr__('amplitude')
+            self.telemetry.append(timestamp, frame.sequence,
+                                  frame.amplitude if frame.amplitude == frame.amplitude else amplitude,
+                                  regulator.lastMargin, regulator.lastPeaks, frame.queue_depth,
+                                  frame.margin)
+        self.frameIndex += len(frames)
+
+    def updateMemoryBudget(self) -> int:
+        """Account memory held by queue and register, throttle acquisition
+        if budget requires it. Throttled acquisition runs at half the rate
+        processFrames drains the queue (at most batchSize frames per tick),
+        so usage falls, above cap acquisition is held until it falls below.
+
+        Returns:
+            int: memory budget shedding level
+        """
+        self.memoryBudget.set('queue', self.deviceManager.data_queue.qsize() * self.frameBytes)
+        self.memoryBudget.set('register', sum(
+            y.nbytes for y in self.deviceManager.amplitudeRegulator.signalRegister
+        ))
+        if self.streamServer != None:
+            self.memoryBudget.set('preview', self.streamServer.queuedBytes)
+
+        level = self.memoryBudget.update()
+        if self.memoryBudget.total >= self.memoryBudget.cap_bytes:
+            delay = float('inf')
+        elif level >= SHED_THROTTLE:
+            delay = max(self.throttleDelay, 2 * self.tickInterval / self.batchSize)
+        else:
+            delay = 0.
+        self.deviceManager.setThrottle(delay)
+        return level
+
+    def setStorageMode(self, mode : str):
+        """Change storage policy of current and future device managers.
+        """
+        self.storageMode = mode
+        if self.deviceManager != None:
+            self.deviceManager.setStorageMode(mode)
+
+    def setControlStrategy(self, strategy : str):
+        """Change amplitude control strategy of current and future device managers.
+        """
+        self.controlStrategy = strategy
+        if self.deviceManager != None:
+            self.deviceManager.amplitudeRegulator.strategy = (
+                # keep behaviour of the original regulator
+                FixedStepStrategy(max_slew=0.02) if strategy == 'fixed'
+                else CONTROL_STRATEGIES[strategy]()
+            )
+
+    def setRegulatorDecimation(self, enabled : bool):
+        """Enable decimation of regulator input of current and future device managers.
+        """
+        self.regulatorDecimation = enabled
+        if self.deviceManager != None:
+            self.deviceManager.amplitudeRegulator.decimator = Decimator() if enabled else None
+
+    def saveBlocker(self) -> tuple | None:
+        """Reason why session can't be saved now.
+
+        Returns:
+            tuple | None: (message, hint) or None if session can be saved
+        """
+        if not self.tempDataAcquired:
+            return 'No data to save!', 'Try performing acquisitioin and saving.'
+
+        if self.acquiring:
+            return 'Acquisition running!', 'Try stoping acquisitioin and saving.'
+
+        if not self.deviceManager.data_queue.empty():
+            return 'Data in queue!', ('Try waiting a while.'
+                                      ' Data in queue waiting to be processed:'
+                                      f' {self.deviceManager.data_queue.qsize()}.')
+        return None
+
+    def save(self, path : str):
+        """Write session into archive in archiveExecutor and start a new journal.
+        Check `saveBlocker` first.
+
+        Returns:
+            concurrent.futures.Future: future of archive being written
+        """
+        metadata = self.collectMetadata()
+        self.telemetry.flush()
+
+        self.archiveFuture = self.archiveExecutor.submit(
+            self.finalizeArchive, self.journalPath, path, metadata,
+            self.deviceManager.osc_call_method('fetch_x_data'),
+            self.journalWrites,
+        )
+        self.journalPath = new_journal_path()
+        self.journalSequence = 0
+        self.journalWrites = []
+        self.frameIndex = 0
+        self.tempDataAcquired = False
+        self.startJournal()
+
+        return self.archiveFuture
+
+    def finalizeArchive(self, journal_path, dest_archive, metadata, x_data_array, journal_writes):
+        """Write archive once all journal appends are done. Runs in archiveExecutor thread.
+        """
+        wait(journal_writes)
+        self.archiveProgress = (0, 1, monotonic())
+        # y data read ahead by compression threads
+        self.memoryBudget.add('writes', READ_AHEAD_BYTES)
+        try:
+            journal_to_archive(journal_path, dest_archive, metadata, x_data_array,
+                               workers=self.archiveWorkers, progress=self.reportArchiveProgress)
+        finally:
+            self.memoryBudget.release('writes', READ_AHEAD_BYTES)
+
+    def reportArchiveProgress(self, done : int, total : int):
+        self.archiveProgress = (done, total, self.archiveProgress[2])
+
+    def archiveStatus(self) -> tuple | None:
+        """Progress of archive being written.
+
+        Returns:
+            tuple | None: (fraction done, ETA in seconds) or None if nothing is written
+        """
+        if self.archiveProgress == None:
+            return None
+
+        done, total, start = self.archiveProgress
+        fraction = done / total if total else 0
+        elapsed  = monotonic() - start
+        eta      = elapsed * (1 - fraction) / fraction if fraction > 0 else float('nan')
+        return fraction, eta
+
+    def status(self) -> dict:
+        """Summary of the session (headless control socket).
+        """
+        status = {
+            'connected'     : self.deviceManager != None,
+            'restarting'    : self.deviceManager != None and not self.devicesReady,
+            'acquiring'     : self.acquiring,
+            'journal'       : self.journalPath,
+            'frames'        : self.frameIndex,
+            'trigger_rate'  : finite_or_none(self.rateMeter.rate),
+            'dead_time'     : finite_or_none(self.rateMeter.deadTime),
+            'stored_frames' : self.journalSequence,
+            'storage_mode'  : self.storageMode,
+            'strategy'      : self.controlStrategy,
+            'memory'        : self.memoryBudget.report(),
+            'saving'        : self.archiveFuture != None and not self.archiveFuture.done(),
+            'subscribers'   : self.streamServer.subscribers if self.streamServer != None else None,
+        }
+        if self.deviceSupervisor != None:
+            status['statistics'] = {
+                name: self.deviceSupervisor.statistic(name)
+                for name in STATISTICS
+            }
+        if self.devicesReady:
+            status['amplitude'] = self.deviceManager.gen__getattr__('amplitude')
+            status['frequency'] = self.deviceManager.gen__getattr__('frequency')
+            status['margin']    = finite_or_none(self.deviceManager.amplitudeRegulator.lastMargin)
+        return status
+
+    def close(self):
+        """Stop writers, device processes and remove journal if it's empty.
+        """
+        self.archiveExecutor.shutdown(wait=True)
+        self.poolExecutor.shutdown(wait=True)
+        self.setStreaming(None)
+
+        if self.telemetry != None:
+            self.telemetry.flush()
+
+        # journal without frames isn't worth recovering
+        if not os.path.exists(self.journalPath):
+            remove_journal(self.journalPath)
+
+        if self.deviceSupervisor != None:
+            self.deviceSupervisor.stop()
+            if self.deviceManager.amplitudeRegulator.spectralEngine != None:
+                self.deviceManager.amplitudeRegulator.spectralEngine.shutdown()
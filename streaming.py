@@ -0,0 +1,310 @@
+"""Live frame streaming to local analysis clients.
+
+StreamServer publishes processed frames over TCP or unix socket, addresses
+are 'host:port' or 'unix:<path>'. Client connects and sends one json line
+with its options ({"decimation": n, "max_queue": n}, empty line for
+defaults), then receives messages:
+
+    header  : magic (4s), kind (B), flags (B), dropped (H), length (I),
+              sequence (Q), timestamp (d), y_increment (d), y_origin (d), y_reference (d)
+    payload : length bytes
+
+Metadata messages (KIND_METADATA) carry json with session metadata and
+scope preamble, they're sent on connect and whenever metadata changes.
+Frame messages (KIND_FRAME) carry acquisition number (sequence), host
+time.monotonic() of the trigger and int16 samples re-quantized with the scope
+preamble (lossless, frames are fetched as 16-bit words), voltage is
+(raw - y_reference) * y_increment + y_origin. `dropped` is the number of
+frames dropped for this subscriber since its previous frame message.
+
+Each subscriber has its own bounded queue, when a client doesn't keep up
+the oldest frames are dropped, acquisition is never blocked.
+"""
+import asyncio
+import json
+import os
+import socket
+import struct
+from collections import deque
+from threading import Thread, Lock
+from time import monotonic
+
+from numpy import frombuffer, rint, int16, iinfo
+from numpy.typing import NDArray
+
+MAGIC           = b'BBLS'
+HEADER          = struct.Struct('<4sBBHIQdddd')
+KIND_METADATA   = 1
+KIND_FRAME      = 2
+FLAG_FLAGGED    = 1
+
+DEFAULT_ADDRESS = 'localhost:50250'
+
+def parse_address(address : str) -> tuple:
+    """Returns ('unix', path) or ('tcp', (host, port)).
+    """
+    if address.startswith('unix:'):
+        return 'unix', os.path.expanduser(address[len('unix:'):])
+    host, _, port = address.rpartition(':')
+    return 'tcp', (host or 'localhost', int(port))
+
+def quantize(y : NDArray, preamble : dict) -> NDArray:
+    """Inverse of Oscilloscope.fetch_y_data scaling.
+    """
+    raw = rint((y - preamble['y_origin']) / preamble['y_increment'] + preamble['y_reference'])
+    return raw.clip(iinfo(int16).min, iinfo(int16).max).astype('<i2')
+
+def dequantize(raw : NDArray, y_increment : float, y_origin : float, y_reference : float) -> NDArray:
+    return (raw - y_reference) * y_increment + y_origin
+
+class _Subscriber:
+    def __init__(self, writer : asyncio.StreamWriter, decimation : int, max_queue : int) -> None:
+        self.writer     = writer
+        self.decimation = max(1, decimation)
+        self.queue      = deque(maxlen=max(1, max_queue))
+        self.ready      = asyncio.Event()
+        self.offered    = 0     # frames offered, for decimation
+        self.task       = asyncio.current_task()
+        self.dropped    = 0     # frames dropped since last sent frame
+
+class StreamServer:
+    def __init__(self, address : str = DEFAULT_ADDRESS, max_queue : int = 64) -> None:
+        """Frame streaming server running its own asyncio loop in a daemon thread.
+        `publish` is thread safe and never blocks on clients.
+
+        Args:
+            address (str, optional): 'host:port' or 'unix:<path>'. Defaults to DEFAULT_ADDRESS.
+            max_queue (int, optional): default (and max) queue length of subscriber. Defaults to 64.
+        """
+        self.address        = address
+        self.max_queue      = max_queue
+
+        self.metadata       = {}
+        self.preamble       = None
+        self.sequence       = 0     # acquisition number of the last published frame
+
+        self._lock          = Lock()
+        self._subscribers   = set()
+        self._loop          = None
+        self._server        = None
+        self._thread        = None
+
+    def start(self) -> None:
+        """Start serving, returns once socket is listening.
+        """
+        self._loop = asyncio.new_event_loop()
+        family, target = parse_address(self.address)
+        if family == 'unix':
+            if os.path.exists(target):
+                os.remove(target)
+            serve = asyncio.start_unix_server(self._handle, path=target)
+        else:
+            serve = asyncio.start_server(self._handle, *target)
+        self._server = self._loop.run_until_complete(serve)
+
+        self._thread = Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        print('Streaming frames on:', self.address)
+
+    def stop(self) -> None:
+        if self._loop is None:
+            return
+
+        async def shutdown():
+            self._server.close()
+            with self._lock:
+                tasks = [subscriber.task for subscriber in self._subscribers]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+        self._loop.close()
+        self._loop = None
+
+        family, target = parse_address(self.address)
+        if family == 'unix' and os.path.exists(target):
+            os.remove(target)
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    @property
+    def queuedBytes(self) -> int:
+        """Memory held by subscriber queues (memory budget 'preview').
+        """
+        with self._lock:
+            # items are shared by subscribers
+            items = {id(item): item for subscriber in self._subscribers for item in subscriber.queue}
+        return sum(len(item[-1]) for item in items.values())
+
+    def setMetadata(self, metadata : dict, preamble : dict) -> None:
+        """Update session metadata and scope preamble used for quantization,
+        subscribers are sent the new metadata.
+        """
+        self.metadata, self.preamble = metadata, preamble
+        if self._loop is None:
+            return
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            self._loop.call_soon_threadsafe(self._sendMetadata, subscriber)
+
+    def publish(self, frames : list) -> None:
+        """Queue frames (workers.Frame) for subscribers.
+        """
+        if self._loop is None or self.preamble is None or not frames:
+            return
+
+        scaling = (self.preamble['y_increment'], self.preamble['y_origin'], self.preamble['y_reference'])
+        with self._lock:
+            subscribers = list(self._subscribers)
+            for frame in frames:
+                self.sequence = frame.sequence
+                item = None
+                for subscriber in subscribers:
+                    subscriber.offered += 1
+                    if (subscriber.offered - 1) % subscriber.decimation:
+                        continue
+                    if item is None:
+                        # quantized once, shared by subscribers
+                        item = (max(frame.sequence, 0), frame.timestamp, FLAG_FLAGGED if frame.flagged else 0,
+                                scaling, quantize(frame.y, self.preamble).tobytes())
+                    if len(subscriber.queue) == subscriber.queue.maxlen:
+                        subscriber.dropped += 1
+                    subscriber.queue.append(item)
+
+        for subscriber in subscribers:
+            self._loop.call_soon_threadsafe(subscriber.ready.set)
+
+    def _sendMetadata(self, subscriber : _Subscriber) -> None:
+        payload = json.dumps({'metadata': self.metadata, 'preamble': self.preamble}).encode()
+        subscriber.writer.write(
+            HEADER.pack(MAGIC, KIND_METADATA, 0, 0, len(payload), max(self.sequence, 0), monotonic(), 0., 0., 0.)
+            + payload
+        )
+
+    async def _handle(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter) -> None:
+        try:
+            options = json.loads(await reader.readline())
+        except ValueError:
+            options = {}
+        if not isinstance(options, dict):
+            options = {}
+
+        subscriber = _Subscriber(writer,
+                                 int(options.get('decimation', 1)),
+                                 min(int(options.get('max_queue', self.max_queue)), self.max_queue))
+        with self._lock:
+            self._subscribers.add(subscriber)
+
+        try:
+            self._sendMetadata(subscriber)
+            while not writer.is_closing():
+                await subscriber.ready.wait()
+                subscriber.ready.clear()
+
+                while True:
+                    with self._lock:
+                        if not subscriber.queue:
+                            break
+                        sequence, timestamp, flags, scaling, payload = subscriber.queue.popleft()
+                        dropped, subscriber.dropped = subscriber.dropped, 0
+
+                    writer.write(HEADER.pack(MAGIC, KIND_FRAME, flags, min(dropped, 0xFFFF),
+                                             len(payload), sequence, timestamp, *scaling) + payload)
+                    # per-subscriber backpressure, frames pile up (and drop) in its queue
+                    await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            with self._lock:
+                self._subscribers.discard(subscriber)
+            writer.close()
+
+class StreamClient:
+    def __init__(self, address : str = DEFAULT_ADDRESS, decimation : int = 1,
+                 max_queue : int = 64, raw : bool = False, timeout : float = None) -> None:
+        """Subscriber of StreamServer. Iterating yields frames as numpy arrays.
+
+            with StreamClient('localhost:50250', decimation=4) as client:
+                for y in client:
+                    ...
+
+        Args:
+            address (str, optional): server address. Defaults to DEFAULT_ADDRESS.
+            decimation (int, optional): receive every n-th frame. Defaults to 1.
+            max_queue (int, optional): frames queued on server for this client. Defaults to 64.
+            raw (bool, optional): yield int16 samples instead of voltage. Defaults to False.
+            timeout (float, optional): socket timeout in seconds. Defaults to None (blocking).
+        """
+        self.raw        = raw
+        self.metadata   = {}
+        self.preamble   = None
+        self.header     = None  # header fields of the last frame
+        self.dropped    = 0     # frames dropped by server for this client
+
+        family, target = parse_address(address)
+        if family == 'unix':
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(target)
+        self._socket.sendall(json.dumps({'decimation': decimation, 'max_queue': max_queue}).encode() + b'\n')
+
+    def _receive(self, size : int) -> bytearray:
+        buffer = bytearray(size)
+        view, received = memoryview(buffer), 0
+        while received < size:
+            n = self._socket.recv_into(view[received:])
+            if not n:
+                raise EOFError('Stream closed by server.')
+            received += n
+        return buffer
+
+    def __iter__(self):
+        try:
+            while True:
+                magic, kind, flags, dropped, length, *fields = HEADER.unpack(self._receive(HEADER.size))
+                if magic != MAGIC:
+                    raise ValueError('Stream out of sync.')
+                payload = self._receive(length)
+
+                if kind == KIND_METADATA:
+                    message = json.loads(payload)
+                    self.metadata, self.preamble = message['metadata'], message['preamble']
+                    continue
+
+                self.dropped += dropped
+                self.header = dict(zip(('flags', 'sequence', 'timestamp', 'y_increment',
+                                        'y_origin', 'y_reference'), (flags, *fields)))
+                y = frombuffer(payload, dtype='<i2')
+                yield y if self.raw else dequantize(y, *fields[2:])
+        except EOFError:
+            return
+
+    def close(self) -> None:
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Print summary of frames streamed by bubbles GUI.')
+    parser.add_argument('address', nargs='?', default=DEFAULT_ADDRESS, help="'host:port' or 'unix:<path>'")
+    parser.add_argument('--decimation', type=int, default=1, help='receive every n-th frame')
+    args = parser.parse_args()
+
+    with StreamClient(args.address, args.decimation) as client:
+        for y in client:
+            print(f"#{client.header['sequence']} {len(y)} samples, "
+                  f"min {y.min():.4g} V, max {y.max():.4g} V, dropped {client.dropped}")
@@ -0,0 +1,180 @@
+"""Columnar session telemetry.
+
+Telemetry rows (one per processed frame) are kept in `array.array` column
+buffers and flushed in blocks to one raw binary file per column
+(`<column>.bin`) in a directory next to the session journal. Archives bundle
+these files as `telemetry/<column>.bin` members, the schema (column dtypes
+and number of rows) is stored under 'telemetry' key of metadata. Columns can
+be read from archive without touching the waveforms, see `read_telemetry`.
+"""
+import json
+import os
+import shutil
+import zipfile
+from array import array
+
+from numpy import frombuffer, dtype, nan
+
+# column name, array typecode
+# frame columns are measured per frame in the device process, regulator
+# columns are the regulator state when the frame was processed - regulator
+# works on the register of recent frames, so they're shared by frames
+# processed in the same update
+COLUMNS = (
+    ('timestamp',   'd'),   # frame: host time of trigger (s since epoch)
+    ('frame',       'q'),   # frame: acquisition number (workers.Frame.sequence)
+    ('amplitude',   'd'),   # frame: generator amplitude in effect during acquisition (Vpp)
+    ('margin',      'd'),   # regulator: subharmonic margin of the last spectrum
+    ('peak_3_2',    'd'),   # regulator: peak magnitude at 3/2 f0
+    ('peak_5_2',    'd'),   # regulator: peak magnitude at 5/2 f0
+    ('queue_depth', 'q'),   # frame: frames waiting in data queue when it was queued (-1 unknown)
+    ('frame_margin','d'),   # frame: FrameClassifier subharmonic margin (nan if not configured)
+)
+
+def telemetry_directory(journal_path : str) -> str:
+    """Telemetry directory of the session journal.
+    """
+    return journal_path + '.telemetry'
+
+def column_dtypes() -> dict:
+    """numpy dtypes of columns (as strings, stored in schema).
+    """
+    return {name: dtype(typecode).newbyteorder('=').str for name, typecode in COLUMNS}
+
+class TelemetryLog:
+    def __init__(self, directory : str, block_size : int = 1024) -> None:
+        """Append-only telemetry log of a session.
+
+        Args:
+            directory (str): directory of column files, created if missing
+            block_size (int, optional): rows buffered before flush. Defaults to 1024.
+        """
+        self.directory  = directory
+        self.block_size = block_size
+        self.columns    = {name: array(typecode) for name, typecode in COLUMNS}
+        self.flushed    = 0
+
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'schema.json'), 'w') as file:
+            json.dump({'columns': column_dtypes()}, file, indent=4)
+
+    @property
+    def rows(self) -> int:
+        return self.flushed + len(self.columns['frame'])
+
+    def append(self, timestamp : float, frame : int, amplitude : float,
+               margin : float = nan, peaks : tuple = (nan, nan), queue_depth : int = 0,
+               frame_margin : float = nan) -> None:
+        """Append row, flushes once block_size rows are buffered.
+        """
+        row = (timestamp, frame, amplitude, margin, peaks[0], peaks[1], queue_depth, frame_margin)
+        for column, value in zip(self.columns.values(), row):
+            column.append(value)
+
+        if len(self.columns['frame']) >= self.block_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write buffered rows to column files.
+        """
+        rows = len(self.columns['frame'])
+        if not rows:
+            return
+
+        for name, column in self.columns.items():
+            with open(os.path.join(self.directory, f'{name}.bin'), 'ab') as file:
+                column.tofile(file)
+            del column[:]
+        self.flushed += rows
+
+def read_schema(directory : str) -> dict:
+    """Schema of telemetry directory, number of rows is taken from column files
+    (the shortest one, if the last flush was interrupted).
+    """
+    with open(os.path.join(directory, 'schema.json'), 'r') as file:
+        schema = json.load(file)
+
+    rows = []
+    for name, column_dtype in schema['columns'].items():
+        path = os.path.join(directory, f'{name}.bin')
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        rows.append(size // dtype(column_dtype).itemsize)
+    schema['rows'] = min(rows, default=0)
+
+    return schema
+
+def telemetry_members(directory : str) -> dict:
+    """Column files of telemetry directory.
+
+    Returns:
+        dict: {archive member name: path}
+    """
+    return {
+        f'telemetry/{name}.bin': os.path.join(directory, f'{name}.bin')
+        for name, _ in COLUMNS
+        if os.path.exists(os.path.join(directory, f'{name}.bin'))
+    }
+
+def remove_telemetry(directory : str) -> None:
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+
+def read_telemetry(source : str, columns : list = None,
+                   start : int = 0, stop : int = None) -> dict:
+    """Reads telemetry columns of archive or telemetry directory. Only
+    metadata and requested column members are read from archive.
+
+    Args:
+        source (str): archive (.zip) or telemetry directory
+        columns (list, optional): column names. Defaults to None (all columns).
+        start (int, optional): first row. Defaults to 0.
+        stop (int, optional): row after the last one. Defaults to None (all rows).
+
+    Returns:
+        dict: {column name: numpy array}
+    """
+    if os.path.isdir(source):
+        schema = read_schema(source)
+        def read(name):
+            with open(os.path.join(source, f'{name}.bin'), 'rb') as file:
+                return file.read()
+        archive_file = None
+    else:
+        archive_file = zipfile.ZipFile(source, 'r')
+        names = archive_file.namelist()
+        metadata_name = next(n for n in names if n.endswith('metadata.txt'))
+        directory = os.path.dirname(metadata_name)
+
+        schema = json.loads(archive_file.read(metadata_name)).get('telemetry')
+        if schema is None:
+            archive_file.close()
+            raise ValueError(f'{source} has no telemetry.')
+        read = lambda name: archive_file.read(
+            os.path.join(directory, 'telemetry', f'{name}.bin')
+        )
+
+    try:
+        rows = slice(start, schema['rows'] if stop is None else min(stop, schema['rows']))
+        return {
+            name: frombuffer(read(name), dtype=schema['columns'][name])[rows]
+            for name in (columns or schema['columns'])
+        }
+    finally:
+        if archive_file is not None:
+            archive_file.close()
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Print session telemetry as csv.')
+    parser.add_argument('source', help='archive (.zip) or telemetry directory')
+    parser.add_argument('--columns', nargs='+', choices=[name for name, _ in COLUMNS])
+    parser.add_argument('--start', type=int, default=0, help='first row')
+    parser.add_argument('--stop', type=int, default=None, help='row after the last one')
+    args = parser.parse_args()
+
+    telemetry = read_telemetry(args.source, args.columns, args.start, args.stop)
+
+    print(','.join(telemetry))
+    for row in zip(*telemetry.values()):
+        print(','.join(str(value) for value in row))
@@ -2,9 +2,9 @@ from typing import Tuple, Union
 from PyQt6.QtWidgets import (QMainWindow, QApplication, QGroupBox, QLabel,
                              QGridLayout, QWidget, QPushButton, QFileDialog,
                              QMessageBox, QDialogButtonBox, QDialog, QVBoxLayout,
-                             QComboBox)
+                             QComboBox, QProgressBar)
 
-from PyQt6.QtGui import QAction
+from PyQt6.QtGui import QAction, QActionGroup
 from PyQt6.QtCore import Qt, QTimer
 
 from abc import abstractmethod
@@ -31,6 +31,7 @@ class ConnectionDialog(QDialog):
         )
 
         self.buttonBox = QDialogButtonBox(QBtn)
+        self.rescanButton = self.buttonBox.addButton('Rescan', QDialogButtonBox.ButtonRole.ResetRole)
 
         self.buttonBox.accepted.connect(self.close)
         self.buttonBox.rejected.connect(self.close)
@@ -53,6 +54,20 @@ class ConnectionDialog(QDialog):
         layout.addWidget(self.buttonBox)
         self.setLayout(layout)
 
+    def setItems(self, item_list : Tuple[str]) -> None:
+        """Replace listed devices, selected device (matched by 'idVendor:idProduct') is kept.
+        """
+        for combo in (self.comboGen, self.comboOsc):
+            if [combo.itemText(i) for i in range(combo.count())] == list(item_list):
+                continue
+            selected = combo.currentText().split(' ')[0]
+            combo.clear()
+            combo.addItems(item_list)
+            for i, item in enumerate(item_list):
+                if selected and item.split(' ')[0] == selected:
+                    combo.setCurrentIndex(i)
+                    break
+
 class GeneratorGroupBox(QGroupBox):
     def __init__(self):
         super().__init__('Generator')
@@ -171,6 +186,12 @@ class MainWindowBase(QMainWindow):
         centralWidget = QWidget(self)
         centralWidget.setLayout(mainLayout)
         self.setCentralWidget(centralWidget)
+
+        # shown while archive is being written
+        self.archiveProgressBar = QProgressBar()
+        self.archiveProgressBar.setRange(0, 100)
+        self.archiveProgressBar.setVisible(False)
+        self.statusBar().addPermanentWidget(self.archiveProgressBar)
         
         self.createUpdateTimer()
 
@@ -187,6 +208,45 @@ class MainWindowBase(QMainWindow):
         exit_action.triggered.connect(self.close)  # Connect Exit to close the application
 
         menu_bar.addAction(save_action)
+
+        # Storage policy menu, one mode checked at a time
+        storage_menu    = menu_bar.addMenu('S&torage')
+        storage_group   = QActionGroup(self)
+        for mode, label in (
+            ('all',         'Keep all frames'),
+            ('flagged',     'Keep flagged frames and context'),
+            ('decimate',    'Decimate quiet frames'),
+            ):
+            action = QAction(label, self, checkable=True)
+            action.setChecked(mode == 'all')
+            action.triggered.connect(lambda _, mode=mode: self.setStorageMode(mode))
+            storage_group.addAction(action)
+            storage_menu.addAction(action)
+
+        storage_menu.addSeparator()
+        streaming_action = QAction('Stream frames to local clients', self, checkable=True)
+        streaming_action.toggled.connect(self.setStreaming)
+        storage_menu.addAction(streaming_action)
+
+        # Regulator control strategy menu
+        regulator_menu  = menu_bar.addMenu('&Regulator')
+        regulator_group = QActionGroup(self)
+        for strategy, label in (
+            ('bisection',   'Bisection search'),
+            ('pi',          'PI controller'),
+            ('fixed',       'Fixed 20 mV step'),
+            ):
+            action = QAction(label, self, checkable=True)
+            action.setChecked(strategy == 'bisection')
+            action.triggered.connect(lambda _, strategy=strategy: self.setControlStrategy(strategy))
+            regulator_group.addAction(action)
+            regulator_menu.addAction(action)
+
+        regulator_menu.addSeparator()
+        decimation_action = QAction('Decimate input', self, checkable=True)
+        decimation_action.toggled.connect(self.setRegulatorDecimation)
+        regulator_menu.addAction(decimation_action)
+
         menu_bar.addAction(exit_action)
 
     def createUpdateTimer(self):
@@ -196,6 +256,7 @@ class MainWindowBase(QMainWindow):
         # Set up a QTimer
         self.updateTimer = QTimer(self)
         self.updateTimer.setInterval(1000)
+        self.updateTimer.timeout.connect(self.superviseDevices)
         self.updateTimer.timeout.connect(self.updateWidgets)
         self.updateTimer.timeout.connect(self.performBackgroundTasks)
         self.updateTimer.start()
@@ -214,6 +275,13 @@ class MainWindowBase(QMainWindow):
         
         return file_path
 
+    @abstractmethod
+    def superviseDevices(self):
+        """Abstract method for checking health of device communication,
+        called before widgets are updated on each self.updateTimer tick.
+        """
+        pass
+
     @abstractmethod
     def updateWidgets(self):
         """Abstract method for updating widgets on a set interval
@@ -221,6 +289,34 @@ class MainWindowBase(QMainWindow):
         """
         pass
     
+    @abstractmethod
+    def setStorageMode(self, mode : str):
+        """Abstract method for changing which acquired frames are stored
+        (see save_file.StoragePolicy).
+        """
+        pass
+
+    @abstractmethod
+    def setControlStrategy(self, strategy : str):
+        """Abstract method for changing amplitude control strategy
+        (see generator_safety.CONTROL_STRATEGIES).
+        """
+        pass
+
+    @abstractmethod
+    def setRegulatorDecimation(self, enabled : bool):
+        """Abstract method for enabling decimation of regulator input
+        (see generator_safety.Decimator).
+        """
+        pass
+
+    @abstractmethod
+    def setStreaming(self, enabled : bool):
+        """Abstract method for starting/stopping live frame streaming
+        (see streaming.StreamServer).
+        """
+        pass
+
     @abstractmethod
     def performBackgroundTasks(self):
         """Abstract method for performing tasks in the background
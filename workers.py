@@ -1,11 +1,71 @@
-from time import sleep
-from typing import Any
+import os
+import signal
+from contextlib import contextmanager
+from time import sleep, monotonic
+from threading import Lock, Thread, Event as ThreadEvent
+from typing import Any, NamedTuple
+from math import nan
 from types import MethodType
 
-from multiprocessing import Manager, Queue, Process, Event, Pipe
+from multiprocessing import Manager, Queue, Process, Event, Pipe, Value, Array
 
-from generator_safety import AmplitudeRegulator
-from instruments import Generator, Oscilloscope
+from numpy.typing import NDArray
+
+from generator_safety import AmplitudeRegulator, FrameClassifier
+from save_file import StoragePolicy, STORAGE_MODES
+
+# instruments (usbtmc, pyusb) are imported on first connection
+
+_manager      = None
+_manager_lock = Lock()
+
+def shared_manager():
+    """Returns multiprocessing Manager shared by all DeviceManagerProcess
+    objects. Server process is started on first call.
+    """
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = Manager()
+    return _manager
+
+def preload_modules():
+    """Imports modules needed on first connection (scipy, usbtmc, pyusb)
+    and starts manager server. Meant to be run in a background thread
+    after main window is shown.
+    """
+    import scipy.fft, scipy.signal
+    import instruments
+    shared_manager()
+
+# indexes of DeviceManagerProcess.health shared array, times are time.monotonic
+# (system-wide clock, comparable between processes)
+HEALTH_HEARTBEAT    = 0     # time of the last main loop iteration
+HEALTH_DEADLINE     = 1     # deadline of current operation, 0 if idle
+HEALTH_DEVICE       = 2     # device of current operation, 1 - generator, 2 - oscilloscope
+HEALTH_SIZE         = 3
+
+# acquisition statistics kept by DeviceSupervisor across process restarts
+STATISTICS = ('frames', 'faults', 'cancels', 'resets', 'restarts', 'downtime')
+
+class OperationCancelled(Exception):
+    """Raised inside DeviceManagerProcess when watchdog cancels stalled operation.
+    """
+    pass
+
+class Frame(NamedTuple):
+    """Acquired waveform as put on `DeviceManagerProcess.data_queue`.
+    """
+    y               : NDArray   # y values of the waveform
+    flagged         : bool      # FrameClassifier decision
+    store           : bool      # StoragePolicy decision, write frame to disk
+    sequence        : int   = -1    # acquisition number, continues across process restarts
+    timestamp       : float = nan   # host time.monotonic() when trigger was seen
+    trigger_time    : float = nan   # scope trigger time tag, nan if not available
+    transfer_time   : float = nan   # duration of waveform transfer (scope can't trigger)
+    amplitude       : float = nan   # generator amplitude in effect during acquisition
+    margin          : float = nan   # FrameClassifier subharmonic margin of this frame
+    queue_depth     : int   = -1    # frames waiting in data_queue when frame was queued
 
 class DeviceManagerProcess(Process):
     """
@@ -37,10 +97,24 @@ class DeviceManagerProcess(Process):
             Sometimes even full restart of instrumentation won't help.
             Eventually after many restarts and wasted time it will un F itself.
     """
-    def __init__(self, oscilloscopeDevice, generatorDevice=None, autostart=False) -> None:
+    def __init__(self, oscilloscopeDevice, generatorDevice=None, autostart=False,
+                 classifier : FrameClassifier = None, storage_mode : str = 'all',
+                 data_queue : Queue = None, health : Array = None, statistics : Array = None,
+                 call_timeout : float = 5., fetch_timeout : float = 10.) -> None:
         super().__init__()
         self.daemon = True
-        self.data_queue = Manager().Queue()
+        from instruments import Generator, Oscilloscope
+
+        self.data_queue = shared_manager().Queue() if data_queue is None else data_queue
+
+        # shared memory read by DeviceSupervisor watchdog
+        self.health         = Array('d', HEALTH_SIZE) if health is None else health
+        self.statistics     = Array('d', len(STATISTICS)) if statistics is None else statistics
+        self.call_timeout   = call_timeout
+        self.fetch_timeout  = fetch_timeout
+
+        # calls are tagged with ids, late replies to calls which timed out are dropped
+        self._call_id       = 0
 
         # pipes for communication with main thread
         # child pipes accesible only in child thread
@@ -51,6 +125,18 @@ class DeviceManagerProcess(Process):
         self.pause_event.set()
         self.stop_event  = Event()
 
+        # frames are classified and filtered in this process,
+        # storage mode can be changed from the main thread
+        self.classifier     = FrameClassifier() if classifier is None else classifier
+        self.storagePolicy  = StoragePolicy(storage_mode)
+        self._storage_mode  = Value('i', STORAGE_MODES.index(storage_mode))
+
+        # delay after each acquired frame, set by memory budget
+        self._throttle      = Value('d', 0.)
+
+        # disabled after the first failed time tag query
+        self._trigger_time_tags = True
+
         self.__osc = Oscilloscope(oscilloscopeDevice)
         self.__gen = Generator(generatorDevice)
 
@@ -60,12 +146,16 @@ class DeviceManagerProcess(Process):
             self.start()
     
     def updateAmplitude(self):
-        v=self.amplitudeRegulator.updateAmplitude(
+        """Non-blocking, spectrum of register is computed on regulator's
+        spectralEngine and applied on the next call.
+        """
+        v=self.amplitudeRegulator.updateAmplitudeAsync(
             self.gen__getattr__('amplitude'),
             self.gen__getattr__('frequency'),
             self.osc__getattr__('analog_sample_rate'),
         )
-        self.gen__setattr__('amplitude', v)
+        if v is not None:
+            self.gen__setattr__('amplitude', v)
 
     # Those methods should be reworked into something more Pythonic
     # but for now are ok enough
@@ -83,27 +173,71 @@ class DeviceManagerProcess(Process):
         if not self.is_alive():
             raise BrokenPipeError('Process is not running, attributes cannot be accesed!')
         
-        if hasattr(self.__osc, name):
-            self.__parent_osc_attr.send((name, *args))
-        else:
+        if not hasattr(self.__osc, name):
             raise AttributeError('Oscilloscope attribute not found!')
-        
-        if not self.stop_event.is_set():
-            if self.__parent_osc_attr.poll(timeout=timeout):
-                return self.__parent_osc_attr.recv()
+
+        return self._request(self.__parent_osc_attr, name, args, timeout)
         
     def gen_call_method(self, name, *args, timeout=2):
         if not self.is_alive():
             raise BrokenPipeError('Process is not running, attributes cannot be accesed!')
         
-        if hasattr(self.__gen, name):
-            self.__parent_gen_attr.send((name, *args))
-        else:
+        if not hasattr(self.__gen, name):
             raise AttributeError('Generator attribute not found!')
 
-        if not self.stop_event.is_set():
-            if self.__parent_gen_attr.poll(timeout=timeout):
-                return self.__parent_gen_attr.recv()
+        return self._request(self.__parent_gen_attr, name, args, timeout)
+
+    def _request(self, pipe, name : str, args : tuple, timeout : float) -> Any:
+        """Send call to manager process and wait for its reply, None if it
+        doesn't arrive within timeout. Replies to earlier calls (which timed out
+        or were cancelled by watchdog) carry older ids and are discarded.
+        """
+        self._call_id += 1
+        pipe.send((self._call_id, name, *args))
+
+        deadline = monotonic() + timeout
+        while not self.stop_event.is_set() and pipe.poll(timeout=max(0., deadline - monotonic())):
+            call_id, result = pipe.recv()
+            if call_id == self._call_id:
+                return result
+
+    @contextmanager
+    def deadline(self, timeout : float, device : int):
+        """Marks operation on device (HEALTH_DEVICE) which should finish within timeout.
+        """
+        self.health[HEALTH_DEVICE]   = device
+        self.health[HEALTH_DEADLINE] = monotonic() + timeout
+        try:
+            yield
+        finally:
+            self.health[HEALTH_DEADLINE] = 0
+
+    def _cancel_operation(self, signum, frame):
+        """SIGUSR1 handler, watchdog sends it when operation misses its deadline.
+        Handler runs between bytecodes, it can't interrupt a read blocked in libusb,
+        such read is cancelled only when it times out (or by USB reset).
+        """
+        if self.health[HEALTH_DEADLINE] > 0:
+            raise OperationCancelled()
+
+    def _serve_call(self, pipe, device, device_id : int):
+        """Receive (call id, method name, *args) from pipe, call method of device
+        and send back (call id, result).
+        """
+        # Get call id, method name and *args
+        call_id, attr_name, *args=pipe.recv()
+        if hasattr(device, attr_name):
+            attr=getattr(device, attr_name)
+            if type(attr) == MethodType:
+                try:
+                    with self.deadline(self.call_timeout, device_id):
+                        result = attr(*args)
+                except OperationCancelled:
+                    print(f'{attr_name}{tuple(args)} cancelled by watchdog')
+                    result = None
+                pipe.send((call_id, result))
+            else:
+                pipe.send((call_id, None))
 
     def run(self):
         """Main loop of manager process. All calls are performed sequentially
@@ -112,36 +246,114 @@ class DeviceManagerProcess(Process):
             2. oscilloscope calls
             3. y-data fetch
         """
+        signal.signal(signal.SIGUSR1, self._cancel_operation)
+
+        acquiring  = False
+        last_frame = 0.     # monotonic time of the last acquired frame, for throttling
         while not self.stop_event.is_set():
+            self.health[HEALTH_HEARTBEAT] = monotonic()
+
+            # Write coalesced generator settings
+            self.__gen.flush()
+
             # Poll generator attribute pipe
             if self.__child_gen_attr.poll():
-                # Get method name and *args
-                attr_name, *args=self.__child_gen_attr.recv()
-                if hasattr(self.__gen, attr_name):
-                    attr=getattr(self.__gen, attr_name)
-                    if type(attr) == MethodType:
-                        self.__child_gen_attr.send(attr(*args))
-                    else:
-                        self.__child_gen_attr.send(None)
+                self._serve_call(self.__child_gen_attr, self.__gen, 1)
             # Poll osciloscope attribute pipe
             elif self.__child_osc_attr.poll():
-                # Get method name and *args
-                attr_name, *args=self.__child_osc_attr.recv()
-                if hasattr(self.__osc, attr_name):
-                    attr=getattr(self.__osc, attr_name)
-                    if type(attr) == MethodType:
-                        self.__child_osc_attr.send(attr(*args))
-                    else:
-                        self.__child_osc_attr.send(None)
+                self._serve_call(self.__child_osc_attr, self.__osc, 2)
+            # Throttled by memory budget, calls are still served
+            elif self.pause_event.is_set() and monotonic() < last_frame + self._throttle.value:
+                pass
             # Perform data acquisition and put it on data_queue
             elif self.pause_event.is_set():
-                if self.__osc.triggered:
-                    y=self.__osc.fetch_y_data()
-                    self.data_queue.put(y)
-                    del y
+                if not acquiring:
+                    # generator settings may have changed while paused
+                    self.configureClassifier()
+                    acquiring = True
+                try:
+                    with self.deadline(self.fetch_timeout, 2):
+                        y=None
+                        if self.__osc.triggered:
+                            timestamp=monotonic()
+                            y=self.__osc.fetch_y_data()
+                            transfer_time=monotonic() - timestamp
+                            trigger_time=self.fetchTriggerTime()
+                except OperationCancelled:
+                    print('Waveform transfer cancelled by watchdog, clearing oscilloscope.')
+                    self.clearOscilloscope()
+                    y=None
+                if y is not None:
+                    sequence=int(self.statistics[STATISTICS.index('frames')])
+                    self.statistics[STATISTICS.index('frames')] += 1
+                    flagged=self.classifier.classify(y)
+                    self.storagePolicy.mode = STORAGE_MODES[self._storage_mode.value]
+                    amplitude=self.__gen.applied('amplitude')
+                    frame=Frame(y, flagged, False, sequence, timestamp, trigger_time, transfer_time,
+                                nan if amplitude is None else amplitude, self.classifier.lastMargin)
+                    for frame, store in self.storagePolicy(frame, flagged):
+                        self.data_queue.put(frame._replace(store=store, queue_depth=self.data_queue.qsize()))
+                    del y, frame
+                    last_frame = monotonic()
+            elif acquiring:
+                # release frames held back by storage policy
+                for frame, store in self.storagePolicy.flush():
+                    self.data_queue.put(frame._replace(store=store, queue_depth=self.data_queue.qsize()))
+                acquiring = False
             
             sleep(.001)
 
+    def fetchTriggerTime(self) -> float:
+        """Trigger time tag of the last frame, nan if scope doesn't provide them.
+        Query isn't repeated after it failed once.
+        """
+        if not self._trigger_time_tags:
+            return nan
+
+        try:
+            return self.__osc.fetch_trigger_time()
+        except OperationCancelled:
+            raise
+        except Exception as e:
+            print('Trigger time tags not available:', e)
+            self._trigger_time_tags = False
+            self.clearOscilloscope()
+            return nan
+
+    def clearOscilloscope(self):
+        """Clear USBTMC input/output buffers of oscilloscope after cancelled transfer.
+        """
+        try:
+            self.__osc.clear()
+        except Exception as e:
+            print('Clearing oscilloscope failed:', e)
+
+    def configureClassifier(self):
+        """Configure frame classifier with current generator frequency and
+        scope sample rate. Called from within the process on acquisition start.
+        """
+        try:
+            self.classifier.configure(
+                self.__gen.frequency,
+                self.__osc.analog_sample_rate,
+            )
+        except Exception as e:
+            print('Frame classifier not configured, all frames are kept:', e)
+
+    def setStorageMode(self, mode : str):
+        """Set StoragePolicy mode used by acquisition loop.
+
+        Args:
+            mode (str): one of save_file.STORAGE_MODES
+        """
+        self._storage_mode.value = STORAGE_MODES.index(mode)
+
+    def setThrottle(self, delay : float):
+        """Set delay after each acquired frame, 0 disables throttling and
+        inf holds acquisition. Pipe calls are served during the delay.
+        """
+        self._throttle.value = delay
+
     def pause(self):
         """
         Pause acquisition of new waveforms from oscilloscope.
@@ -169,4 +381,235 @@ class DeviceManagerProcess(Process):
         self.stop_event.set()
         self.join(timeout=2)
         self.__osc.close()
-        self.__gen.close()
\ No newline at end of file
+        self.__gen.close()
+
+class DeviceSupervisor:
+    def __init__(self, oscilloscopeDevice, generatorDevice=None, max_restarts : int = None,
+                 heartbeat_timeout : float = 5., escalation_interval : float = 2.,
+                 watch_interval : float = 0.5, **kwargs) -> None:
+        """Starts DeviceManagerProcess, watches its health and restarts it if it dies.
+
+        Watchdog thread reads heartbeat and operation deadline from shared memory.
+        When process stalls (operation past its deadline or no heartbeat) it escalates
+        every escalation_interval:
+            1. cancel operation (SIGUSR1 -> OperationCancelled, buffers are cleared),
+               Python runs the handler only between bytecodes, so it interrupts
+               stalls in Python code but not a read blocked inside libusb, that
+               one ends with USB timeout or the next steps,
+            2. reset USB device of the stalled operation (fails blocked transfer),
+            3. terminate process.
+        Downtime of a fault (stall or crash) lasts until the process beats again.
+        Dead process is replaced by `ensure_running`: instruments are closed and opened
+        again, which clears their status (*CLS) and sets up waveform transfer. Data queue,
+        amplitude regulator, classifier, storage mode, acquisition state and statistics
+        are carried over to the new process. Failed restarts (e.g. instrument unplugged)
+        are retried with exponential backoff, every attempt counts towards max_restarts.
+
+        Args:
+            oscilloscopeDevice (usb.core.Device): oscilloscope device
+            generatorDevice (usb.core.Device, optional): generator device. Defaults to None.
+            max_restarts (int, optional): restart attempts after which supervisor gives up. Defaults to None (never).
+            heartbeat_timeout (float, optional): max time between main loop iterations outside of operations. Defaults to 5.
+            escalation_interval (float, optional): time between escalation steps. Defaults to 2.
+            watch_interval (float, optional): watchdog polling interval. Defaults to 0.5.
+            **kwargs: passed to DeviceManagerProcess
+        """
+        self.oscilloscopeDevice = oscilloscopeDevice
+        self.generatorDevice    = generatorDevice
+        self.max_restarts       = max_restarts
+        self.restarts           = 0     # restart attempts, failed ones included
+        self.max_retry_delay    = 60.
+
+        self._restart_pending   = False # process died, not replaced yet
+        self._fault_start       = None  # monotonic time fault started, None if healthy
+        self._fault_lock        = Lock()
+        self._failed_restarts   = 0
+        self._retry_at          = 0.
+
+        self.heartbeat_timeout      = heartbeat_timeout
+        self.escalation_interval    = escalation_interval
+        self.watch_interval         = watch_interval
+
+        self.health     = Array('d', HEALTH_SIZE)
+        self.statistics = Array('d', len(STATISTICS))
+        self._kwargs    = kwargs
+
+        self.manager = DeviceManagerProcess(oscilloscopeDevice, generatorDevice,
+                                            health=self.health, statistics=self.statistics,
+                                            autostart=True, **kwargs)
+
+        self._stop_watchdog = ThreadEvent()
+        self._watchdog = Thread(target=self.watch, daemon=True)
+        self._watchdog.start()
+
+    def statistic(self, name : str) -> float:
+        return self.statistics[STATISTICS.index(name)]
+
+    def _count(self, name : str, value : float = 1) -> None:
+        self.statistics[STATISTICS.index(name)] += value
+
+    @property
+    def restart_pending(self) -> bool:
+        """True while dead device process waits for (retry of) restart, device
+        calls fail until it's replaced.
+        """
+        return self._restart_pending
+
+    def ensure_running(self) -> DeviceManagerProcess:
+        """Restart device process if it died. Until restart succeeds the dead
+        process is returned.
+
+        Raises:
+            RuntimeError: restart failed more than max_restarts times
+
+        Returns:
+            DeviceManagerProcess: running device process
+        """
+        if not self._restart_pending:
+            if self.manager.is_alive() or self.manager.stop_event.is_set():
+                return self.manager
+            print(f'Device process died (exit code {self.manager.exitcode}), restarting.')
+            self._restart_pending = True
+            self._fault()
+
+        if monotonic() < self._retry_at:
+            return self.manager
+
+        if self.max_restarts is not None and self.restarts >= self.max_restarts:
+            raise RuntimeError(f'Device process could not be restarted after {self.restarts} attempts, giving up.')
+
+        return self.restart()
+
+    def restart(self) -> DeviceManagerProcess:
+        """Replace device process with a new one. If new process can't be
+        created, the next attempt is scheduled with exponential backoff.
+
+        Returns:
+            DeviceManagerProcess: new process, the old one if restart failed
+        """
+        old = self.manager
+        acquiring = old.pause_event.is_set()
+
+        try:
+            old.stop()
+        except Exception as e:
+            print('Closing instruments of dead device process failed:', e)
+
+        # new process has no heartbeat until it starts
+        self.health[HEALTH_HEARTBEAT] = 0
+        self.health[HEALTH_DEADLINE]  = 0
+
+        # counted before instruments are opened, failed attempts count too
+        self.restarts += 1
+        self._count('restarts')
+
+        kwargs = dict(self._kwargs)
+        kwargs.update(
+            classifier=old.classifier,
+            storage_mode=STORAGE_MODES[old._storage_mode.value],
+            data_queue=old.data_queue,
+            health=self.health,
+            statistics=self.statistics,
+        )
+        try:
+            new = DeviceManagerProcess(self.oscilloscopeDevice, self.generatorDevice, **kwargs)
+        except Exception as e:
+            # usb.core.USBError, OSError, ... when instrument is unplugged
+            self._failed_restarts += 1
+            delay = min(self.escalation_interval * 2 ** (self._failed_restarts - 1), self.max_retry_delay)
+            self._retry_at = monotonic() + delay
+            print(f'Restarting device process failed ({e}), retrying in {delay:.1f} s.')
+            return old
+
+        new.amplitudeRegulator = old.amplitudeRegulator
+        if not acquiring:
+            new.play()
+        new.start()
+
+        self.manager = new
+        self._restart_pending, self._failed_restarts, self._retry_at = False, 0, 0.
+        return new
+
+    def stalled(self) -> bool:
+        """True if current operation missed its deadline or main loop stopped beating.
+        """
+        now       = monotonic()
+        deadline  = self.health[HEALTH_DEADLINE]
+        heartbeat = self.health[HEALTH_HEARTBEAT]
+
+        if deadline > 0:
+            return now > deadline
+        return heartbeat > 0 and now - heartbeat > self.heartbeat_timeout
+
+    def reset_device(self) -> None:
+        """USB reset of device of the stalled operation, stalled transfer fails
+        in the device process.
+        """
+        device = (self.generatorDevice if self.health[HEALTH_DEVICE] == 1
+                  else self.oscilloscopeDevice)
+        try:
+            device.reset()
+        except Exception as e:
+            print('USB reset failed:', e)
+
+    def _fault(self) -> None:
+        """Mark start of a fault (stall or death of device process), it lasts
+        until device process beats again. Called by watchdog and ensure_running.
+        """
+        with self._fault_lock:
+            if self._fault_start is None:
+                self._fault_start = monotonic()
+                self._count('faults')
+
+    def watch(self) -> None:
+        """Watchdog loop, run in a daemon thread.
+        """
+        level, last_escalation = 0, 0.
+
+        while not self._stop_watchdog.wait(self.watch_interval):
+            manager = self.manager
+            alive   = manager.is_alive()
+
+            # crashed process, downtime lasts until it's restarted
+            if not alive and (self._restart_pending or not manager.stop_event.is_set()):
+                self._fault()
+                continue
+
+            if not (alive and self.stalled()):
+                # fault ends when (restarted) process beats again
+                with self._fault_lock:
+                    fault_start = self._fault_start
+                    if fault_start is not None and alive and self.health[HEALTH_HEARTBEAT] > 0:
+                        self._fault_start = None
+                        self._count('downtime', monotonic() - fault_start)
+                        print(f'Device process recovered after {monotonic() - fault_start:.1f} s.')
+                        level = 0
+                continue
+
+            now = monotonic()
+            if level == 0:
+                last_escalation = 0.
+                self._fault()
+
+            if now - last_escalation < self.escalation_interval:
+                continue
+            level, last_escalation = level + 1, now
+
+            match level:
+                case 1:
+                    # handler runs only between bytecodes, a read blocked inside
+                    # libusb is interrupted by USB timeout or the next steps
+                    print('Device process stalled, cancelling operation.')
+                    self._count('cancels')
+                    os.kill(manager.pid, signal.SIGUSR1)
+                case 2:
+                    print('Device process still stalled, resetting USB device.')
+                    self._count('resets')
+                    self.reset_device()
+                case _:
+                    print('Device process still stalled, terminating it.')
+                    manager.terminate()
+
+    def stop(self) -> None:
+        self._stop_watchdog.set()
+        self.manager.stop()